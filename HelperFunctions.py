@@ -1,5 +1,13 @@
 import sys
 import os
+import ast
+import json
+import time
+import psutil
+import cProfile
+import itertools
+import contextlib
+import tracemalloc
 import numpy as np
 import pandas as pd
 
@@ -67,6 +75,213 @@ def instrumentSeparation(northOffset,u,v):
 
 #     return(path_string)
 
+## Columnar storage for the metaDir tables
+# Tables with a TIMESTAMP index are partitioned by month (path/YYYY-MM.parquet), others are saved as path.parquet
+# Requires pyarrow, MultiIndex column headers are preserved in the parquet metadata
+def readMetadataTable(path,dateRange=None,partition=True):
+    if partition == False:
+        if os.path.isfile(path+'.parquet'):
+            return(pd.read_parquet(path+'.parquet'))
+        return(pd.DataFrame())
+    if os.path.isdir(path) == False:
+        return(pd.DataFrame())
+    partitions = sorted(f for f in os.listdir(path) if f.endswith('.parquet'))
+    if dateRange is not None:
+        # Only load the partitions which overlap the dateRange
+        start,end = dateRange.min().to_period('M'),dateRange.max().to_period('M')
+        partitions = [f for f in partitions if start <= pd.Period(f.split('.')[0],freq='M') <= end]
+    if len(partitions) == 0:
+        return(pd.DataFrame())
+    return(pd.concat([pd.read_parquet(f"{path}/{f}") for f in partitions]))
+
+def writeMetadataTable(df,path,partition=True,months=None):
+    # Overwrites the partitions for each month in df (or just those listed in months), other partitions are untouched
+    # Mixed type text columns are cast to str (missing values are preserved) so they can be stored as parquet strings
+    if partition == True and months is not None:
+        df = df.loc[df.index.to_period('M').isin(months)]
+    df = df.copy()
+    for c in df.columns[df.dtypes == 'object']:
+        df[c] = df[c].where(df[c].isnull(),df[c].astype(str))
+    if partition == False:
+        df.to_parquet(path+'.parquet.tmp')
+        os.replace(path+'.parquet.tmp',path+'.parquet')
+        return
+    os.makedirs(path,exist_ok=True)
+    for month,partition in df.groupby(df.index.to_period('M')):
+        fn = f"{path}/{month.strftime('%Y-%m')}.parquet"
+        partition.to_parquet(fn+'.tmp')
+        os.replace(fn+'.tmp',fn)
+
+## Compiled dataFilters expressions
+# Filters (see config.yml: monitoringInstructions>dataFilters) are parsed into a tree of comparisons and boolean operations
+# which are evaluated on a 2D array of the selected statistics, arbitrary code is never evaluated
+# Data.loc[groupIX,variables], Data, or x refer to the selected statistics, e.g.: Data.loc[groupIX,variables]<-100 or (x<-100)|(x>100)
+filterComparisons = {ast.Lt:np.less,ast.LtE:np.less_equal,ast.Gt:np.greater,ast.GtE:np.greater_equal,ast.Eq:np.equal,ast.NotEq:np.not_equal}
+filterBoolean = {ast.And:np.logical_and,ast.Or:np.logical_or,ast.BitAnd:np.logical_and,ast.BitOr:np.logical_or}
+
+def compileFilter(expression):
+    # Returns a function of the data array, a list of expressions is combined with "or"
+    if type(expression) == list:
+        compiled = [compileFilter(e) for e in expression]
+        return(lambda x: np.logical_or.reduce([f(x) for f in compiled]))
+    try:
+        tree = ast.parse(str(expression).strip(),mode='eval')
+    except SyntaxError:
+        raise ValueError(f'Invalid filter: {expression}')
+    return(compileFilterNode(tree.body,expression))
+
+def compileFilterNode(node,expression):
+    if isinstance(node,ast.Compare):
+        operands = [compileFilterNode(node.left,expression)]+[compileFilterNode(c,expression) for c in node.comparators]
+        operators = [filterComparisons[type(op)] for op in node.ops if type(op) in filterComparisons]
+        if len(operators) != len(node.ops):
+            raise ValueError(f'Unsupported comparison in filter: {expression}')
+        def compare(x):
+            result = True
+            for op,left,right in zip(operators,operands[:-1],operands[1:]):
+                result = np.logical_and(result,op(left(x),right(x)))
+            return(result)
+        return(compare)
+    elif isinstance(node,ast.BoolOp) and type(node.op) in filterBoolean:
+        values = [compileFilterNode(v,expression) for v in node.values]
+        op = filterBoolean[type(node.op)]
+        return(lambda x: op.reduce([v(x) for v in values]))
+    elif isinstance(node,ast.BinOp) and type(node.op) in filterBoolean:
+        left,right = compileFilterNode(node.left,expression),compileFilterNode(node.right,expression)
+        op = filterBoolean[type(node.op)]
+        return(lambda x: op(left(x),right(x)))
+    elif isinstance(node,ast.UnaryOp) and type(node.op) in [ast.Not,ast.Invert]:
+        operand = compileFilterNode(node.operand,expression)
+        return(lambda x: np.logical_not(operand(x)))
+    elif isinstance(node,ast.UnaryOp) and type(node.op) in [ast.USub,ast.UAdd]:
+        operand = compileFilterNode(node.operand,expression)
+        sign = -1 if type(node.op) == ast.USub else 1
+        return(lambda x: sign*operand(x))
+    elif isinstance(node,ast.Constant) and type(node.value) in [int,float]:
+        return(lambda x: node.value)
+    elif isinstance(node,ast.Name) and node.id in ['x','Data']:
+        return(lambda x: x)
+    elif (isinstance(node,ast.Subscript) and isinstance(node.value,ast.Attribute) and node.value.attr == 'loc'
+          and isinstance(node.value.value,ast.Name) and node.value.value.id == 'Data'):
+        return(lambda x: x)
+    raise ValueError(f'Unsupported expression "{ast.unparse(node)}" in filter: {expression}')
+
+## Structured tracing of a run: run > stage > month > file or batch
+# Each span records its wall time, CPU time (of the process), bytes read (by the process) and PID
+# Spans are appended to traceDir/spans_{pid}.jsonl as they close, so worker processes report back through the trace directory
+# save() (in the parent) attaches the root spans of each worker to the innermost parent span which was open when they started
+# and writes spans.jsonl and trace.json (chrome://tracing or https://ui.perfetto.dev)
+# Stages listed in profile/profileMemory are profiled with cProfile/tracemalloc, even if tracing is off
+spanCount = itertools.count()
+tracers = {}
+
+def processTracer(traceDir):
+    # One tracer per process and trace directory, used in worker processes (disabled if traceDir is None)
+    key = (os.getpid(),traceDir)
+    if key not in tracers:
+        tracers[key] = stageTracer(traceDir,enabled=traceDir is not None)
+    return(tracers[key])
+
+class stageTracer():
+    def __init__(self,traceDir,enabled=True,profile=[],profileMemory=[]):
+        self.traceDir = traceDir
+        self.enabled = enabled
+        self.profile = profile
+        self.profileMemory = profileMemory
+        self.pid = os.getpid()
+        self.stack = []
+        self.log = None
+        self.profiling = False
+        self.process = psutil.Process()
+        if traceDir is not None and (enabled or len(profile)>0 or len(profileMemory)>0):
+            os.makedirs(traceDir,exist_ok=True)
+        if enabled:
+            # Spans opened through processTracer in this process nest under the spans of this tracer
+            tracers.setdefault((self.pid,traceDir),self)
+
+    def bytesRead(self):
+        # Bytes read by the process (including from the page cache on Linux), not available on all platforms
+        try:
+            io = self.process.io_counters()
+            return(getattr(io,'read_chars',io.read_bytes))
+        except (AttributeError,psutil.Error):
+            return(None)
+
+    @contextlib.contextmanager
+    def span(self,name,cat='stage',**args):
+        profile = name in self.profile and self.profiling == False
+        profileMemory = name in self.profileMemory and tracemalloc.is_tracing() == False
+        if self.enabled == False and profile == False and profileMemory == False:
+            yield
+            return
+        if profile:
+            self.profiling = cProfile.Profile()
+            self.profiling.enable()
+        if profileMemory:
+            tracemalloc.start()
+        span = {'name':name,'cat':cat,'id':f"{self.pid}.{next(spanCount)}",
+                'parent':self.stack[-1] if len(self.stack)>0 else None,'pid':self.pid}
+        self.stack.append(span['id'])
+        bytesRead,cpu,T1,wall = self.bytesRead(),time.process_time(),time.time(),time.perf_counter()
+        try:
+            yield
+        finally:
+            span['start'] = T1
+            span['wall'] = time.perf_counter()-wall
+            span['cpu'] = time.process_time()-cpu
+            span['bytesRead'] = self.bytesRead()-bytesRead if bytesRead is not None else None
+            span['args'] = args
+            self.stack.pop()
+            if profile:
+                self.profiling.disable()
+                self.profiling.dump_stats(f"{self.traceDir}/{name}_{self.pid}.prof")
+                self.profiling = False
+            if profileMemory:
+                snapshot = tracemalloc.take_snapshot()
+                span['args']['peakMemory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                with open(f"{self.traceDir}/{name}_{self.pid}_memory.txt",'w') as f:
+                    f.write(f"Peak traced memory: {span['args']['peakMemory']} bytes\n")
+                    f.write('\n'.join(str(stat) for stat in snapshot.statistics('lineno')[:50])+'\n')
+            if self.enabled:
+                self.write(span)
+
+    def write(self,span):
+        if self.log is None:
+            self.log = open(f"{self.traceDir}/spans_{self.pid}.jsonl",'a',buffering=1)
+        self.log.write(json.dumps(span,default=str)+'\n')
+
+    def save(self):
+        # Merge the spans of all processes, returns the list of spans (empty if tracing is off)
+        if self.enabled == False or os.path.isdir(self.traceDir) == False:
+            return([])
+        if self.log is not None:
+            self.log.flush()
+        spans = []
+        for fn in sorted(os.listdir(self.traceDir)):
+            if fn.startswith('spans_') and fn.endswith('.jsonl'):
+                with open(f"{self.traceDir}/{fn}") as f:
+                    spans += [json.loads(line) for line in f if line.strip() != '']
+        spans.sort(key=lambda span: span['start'])
+        # Worker spans are nested under the innermost run/stage/month span open in the parent
+        parents = [span for span in spans if span['pid'] == self.pid and span['cat'] in ['run','stage','month']]
+        for span in spans:
+            if span['parent'] is None and span['pid'] != self.pid:
+                containing = [p for p in parents if p['start'] <= span['start'] <= p['start']+p['wall']]
+                if len(containing)>0:
+                    span['parent'] = max(containing,key=lambda p: p['start'])['id']
+        with open(f"{self.traceDir}/spans.jsonl",'w') as f:
+            f.write(''.join(json.dumps(span,default=str)+'\n' for span in spans))
+        events = [{'name':'process_name','ph':'M','pid':pid,'tid':0,
+                   'args':{'name':'main' if pid == self.pid else f'worker {pid}'}} for pid in set(span['pid'] for span in spans)]
+        events += [{'name':span['name'],'cat':span['cat'],'ph':'X','pid':span['pid'],'tid':0,
+                    'ts':span['start']*1e6,'dur':span['wall']*1e6,
+                    'args':span['args']|{'cpu':span['cpu'],'bytesRead':span['bytesRead']}} for span in spans]
+        with open(f"{self.traceDir}/trace.json",'w') as f:
+            json.dump({'traceEvents':events,'displayTimeUnit':'ms'},f,default=str)
+        print(f'Trace saved to {self.traceDir}')
+        return(spans)
+
 ## Progress bar to update status of a run
 class progressbar():
 
@@ -3,41 +3,110 @@
 
 import os
 import re
+import ast
 import sys
+import glob
+import json
+import time
+import uuid
 import yaml
 import psutil
 import shutil
+import socket
 import zipfile
 import warnings
+import heapq
+import hashlib
 import datetime
+import threading
 import importlib
 import subprocess
 import numpy as np
 import pandas as pd
 import configparser
-from io import TextIOWrapper
+from types import MappingProxyType
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import readLiConfigFiles as rLCF
+from HelperFunctions import processTracer
 importlib.reload(rLCF)
 
 def set_high_priority():
+    # Windows only, raising the priority of a process on POSIX systems requires elevated permissions
+    if sys.platform.startswith("win"):
+        p = psutil.Process(os.getpid())
+        p.nice(psutil.HIGH_PRIORITY_CLASS)
+
+# Priority classes (as used by wmic setpriority) -> POSIX nice value and I/O class (ionice best effort level or idle)
+posixPriority = {
+    'idle':(19,'idle'),
+    'belownormal':(10,7),
+    'normal':(0,None),
+    'abovenormal':(-5,2),
+    'highpriority':(-10,0),
+    'realtime':(-20,0)
+    }
+
+def set_posix_priority(priority,affinity=None):
+    # Applied to the current process, used to set the priority of the EddyPro processes before they start
+    # Settings which are not permitted (e.g., negative nice values without root) or not supported are skipped
     p = psutil.Process(os.getpid())
-    p.nice(psutil.HIGH_PRIORITY_CLASS)
+    nice,io = posixPriority.get(priority.lower().replace(' ',''),(0,None))
+    try:
+        p.nice(nice)
+    except (psutil.AccessDenied,PermissionError):
+        pass
+    if io is not None and hasattr(p,'ionice'):
+        try:
+            if io == 'idle':
+                p.ionice(psutil.IOPRIO_CLASS_IDLE)
+            else:
+                p.ionice(psutil.IOPRIO_CLASS_BE,value=io)
+        except (psutil.AccessDenied,PermissionError,ValueError):
+            pass
+    if affinity and hasattr(p,'cpu_affinity'):
+        try:
+            p.cpu_affinity(list(affinity))
+        except (psutil.AccessDenied,ValueError):
+            pass
+
+def stageFile(source,dest,mode='link'):
+    # Make source available at dest without copying the data where possible
+    # link: hardlink (same filesystem), then symlink, then fall back to a copy
+    if mode == 'link':
+        try:
+            os.link(source,dest)
+            return('hardlink')
+        except OSError:
+            pass
+        try:
+            os.symlink(source,dest)
+            return('symlink')
+        except OSError:
+            pass
+    shutil.copy2(source,dest)
+    return('copy')
 
 def pasteWithSubprocess(source, dest, option = 'copy',verbose=False):
     set_high_priority()
     cmd=None
-    if sys.platform.startswith("darwin"): 
-        # These need to be tested/flushed out
-        if option == 'copy' or option == 'xcopy':
-            cmd=['cp', source, dest]
-        elif option == 'move':
-            cmd=['mv',source,dest]
-    elif sys.platform.startswith("win"): 
+    shell=False
+    if sys.platform.startswith("win"): 
         cmd=[option, source, dest]
         if option == 'xcopy':
             cmd.append('/s')
+        shell=True
+    else:
+        # Directories are copied by content (as with copy/xcopy on Windows)
+        if option == 'copy' or option == 'xcopy':
+            if os.path.isdir(source):
+                cmd=['cp','-R',source+'/.',dest]
+            else:
+                cmd=['cp', source, dest]
+        elif option == 'move':
+            cmd=['mv',source,dest]
     if cmd:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell)
     if verbose==True:
         print(proc)
     # Copy ghg or dat files and shift timestamp in file name if needed
@@ -69,8 +138,553 @@ def findFiles(inName,in_dir,fileInfo,checkList=[],dateRange=None):
     # return the empty list if any condition failed
     return(empty)
 
+def findFilesBatch(fileList,in_dir,fileInfo,checkList=[],dateRange=None):
+    # Vectorized version of findFiles, parses a full directory listing in one pass
+    # Returns a dataframe aligned with fileList, with rows of NaN/NaT where any condition failed
+    names = pd.Series(fileList,dtype=object)
+    df = pd.DataFrame(index=names.index,columns=['TIMESTAMP','source','filename','file_prototype'],dtype=object)
+    if names.shape[0] == 0:
+        return(df)
+    valid = (names.str.endswith(fileInfo['extension'])&
+             names.str.contains(fileInfo['searchTag'],regex=False)&
+             (names.isin(checkList)==False)&
+             ((fileInfo['excludeTag']+'_'+names).isin(checkList)==False))
+    search = re.compile(fileInfo['search'])
+    srch = names.loc[valid].str.rsplit('.',n=1).str[0].str.extract(f"({search.pattern})",expand=True)[0]
+    TIMESTAMP = pd.to_datetime(srch,format=fileInfo['format'],errors='coerce')
+    if str(fileInfo['timeShift']) != 'None':
+        TIMESTAMP = TIMESTAMP+pd.Timedelta(minutes=float(fileInfo['timeShift']))
+        timeString = TIMESTAMP.dt.strftime(fileInfo['format'])
+        outName = [n.replace(s,t) if type(t) == str else None for n,s,t in zip(names.loc[valid],srch,timeString)]
+    else:
+        outName = names.loc[valid]
+    found = pd.DataFrame(index=srch.index,data={
+        'TIMESTAMP':TIMESTAMP,
+        'source':os.path.abspath(in_dir)+os.sep+names.loc[valid],
+        'filename':outName,
+        'file_prototype':names.loc[valid].str.replace(search,lambda m: fileInfo['ep_date_pattern'],n=1,regex=True),
+        })
+    found = found.loc[found['TIMESTAMP'].isnull()==False]
+    if dateRange is not None:
+        found = found.loc[(found['TIMESTAMP']>=dateRange.min())&(found['TIMESTAMP']<=dateRange.max())]
+    df.loc[found.index] = found
+    df['TIMESTAMP'] = pd.to_datetime(df['TIMESTAMP'])
+    return(df)
+
+class rawFileIndex():
+    # Persistent index of the raw files found in the sourceDir(s), saved as json in the metaDir
+    # Stores the size, mtime and findFiles output of every file so a re-scan only needs to stat directories
+    # Directories with an unchanged mtime are skipped, new or modified files are queued in toParse for findFiles
+    # The index is invalidated if any of the fileInfo settings which change the findFiles output are modified
+    def __init__(self,indexFile,fileInfo):
+        self.indexFile = indexFile
+        self.signature = {key:str(fileInfo[key]) for key in ['extension','search','format','ep_date_pattern','searchTag','excludeTag','timeShift']}
+        self.directories = {}
+        if os.path.isfile(self.indexFile):
+            try:
+                with open(self.indexFile) as f:
+                    stored = json.load(f)
+                if stored['signature'] == self.signature:
+                    self.directories = stored['directories']
+            except:
+                print(f'Could not read {self.indexFile}, rebuilding the raw file index')
+        self.toParse = {}
+        self.visited = set()
+        self.roots = []
+
+    def scan(self,searchDir):
+        # Walk the search directory (without following symlinks, same as os.walk)
+        self.roots.append(os.path.abspath(searchDir))
+        stack = [os.path.abspath(searchDir)]
+        while len(stack)>0:
+            dir = stack.pop()
+            try:
+                mtime = os.stat(dir).st_mtime
+            except OSError:
+                continue
+            self.visited.add(dir)
+            entry = self.directories.get(dir)
+            if entry is not None and entry['mtime'] == mtime:
+                # Contents unchanged, only need to check the subdirectories
+                stack.extend(entry['subdirs'])
+                continue
+            oldFiles = entry['files'] if entry is not None else {}
+            entry = {'mtime':mtime,'subdirs':[],'files':{}}
+            with os.scandir(dir) as it:
+                for f in it:
+                    if f.is_dir(follow_symlinks=False):
+                        entry['subdirs'].append(os.path.abspath(f.path))
+                    elif f.is_file():
+                        st = f.stat()
+                        if f.name in oldFiles and oldFiles[f.name][:2] == [st.st_size,st.st_mtime]:
+                            entry['files'][f.name] = oldFiles[f.name]
+                        else:
+                            entry['files'][f.name] = [st.st_size,st.st_mtime,None,None,None]
+                            self.toParse.setdefault(dir,[]).append(f.name)
+            self.directories[dir] = entry
+            stack.extend(entry['subdirs'])
+
+    def update(self,dir,fileList,dout):
+        # Add the findFiles output ([TIMESTAMP,source,filename,file_prototype]) for newly parsed files
+        for name,out in zip(fileList,dout):
+            if pd.isnull(out[0]) == False:
+                self.directories[dir]['files'][name][2:] = [pd.Timestamp(out[0]).isoformat(),out[2],out[3]]
+        self.toParse.pop(dir,None)
+
+    def save(self):
+        # Drop directories which no longer exist under the scanned roots
+        for dir in list(self.directories.keys()):
+            if dir not in self.visited and any(dir == r or dir.startswith(r+os.sep) for r in self.roots):
+                self.directories.pop(dir)
+        os.makedirs(os.path.dirname(self.indexFile),exist_ok=True)
+        # The index can be shared by several processes (sharded pre-processing), each writes its own temporary file
+        tmp = f'{self.indexFile}.{socket.gethostname()}_{os.getpid()}.tmp'
+        with open(tmp,'w') as f:
+            json.dump({'signature':self.signature,'directories':self.directories},f)
+        os.replace(tmp,self.indexFile)
+
+    def inventory(self):
+        # Dump the indexed files (for the directories visited in this run) to the fileInventory format
+        dout = [[TIMESTAMP,os.path.abspath(f"{dir}/{name}"),filename,file_prototype]
+                for dir in self.visited
+                for name,(size,mtime,TIMESTAMP,filename,file_prototype) in self.directories[dir]['files'].items()
+                if TIMESTAMP is not None]
+        df = pd.DataFrame(columns=['TIMESTAMP','source','filename','file_prototype'],data=dout)
+        df['TIMESTAMP'] = pd.to_datetime(df['TIMESTAMP'])
+        return(df)
+
+class groupRegistry():
+    # Persistent mapping of configuration (groupBy values) -> groupID
+    # Groups are identified by a hash of their groupBy columns and values, so IDs are stable as new data are added
+    # New configurations get the next available ID, IDs are never reused
+    # Columns tagged as missing (nanTag) are left out and columns are sorted, so adding a column to groupBy
+    # (or a new instrument/column in the metadata files) or reordering the columns doesn't change existing IDs
+    def __init__(self,registryFile,nanTag='~'):
+        self.registryFile = registryFile
+        self.nanTag = nanTag
+        self.groups = {}
+        if os.path.isfile(self.registryFile):
+            with open(self.registryFile) as f:
+                self.groups = json.load(f)
+
+    def configuration(self,columns,values):
+        return(sorted(['|'.join(map(str,c)),str(v)] for c,v in zip(columns,values) if str(v) != self.nanTag))
+
+    def key(self,columns,values):
+        config = json.dumps(self.configuration(columns,values))
+        return(hashlib.blake2b(config.encode(),digest_size=16).hexdigest())
+
+    def assign(self,columns,configurations):
+        # configurations is an array of unique groupBy values (one row per configuration), returns the groupIDs
+        ids = []
+        for values in configurations:
+            key = self.key(columns,values)
+            if key not in self.groups:
+                self.groups[key] = {'ID':max([g['ID'] for g in self.groups.values()]+[0])+1,
+                                    'groupBy':dict(self.configuration(columns,values))}
+            ids.append(self.groups[key]['ID'])
+        return(np.array(ids,dtype=np.int32))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.registryFile),exist_ok=True)
+        with open(self.registryFile+'.tmp','w') as f:
+            json.dump(self.groups,f,indent=1)
+        os.replace(self.registryFile+'.tmp',self.registryFile)
+
+# Matches the option lines of configparser's default OPTCRE
+metaDataOption = re.compile(r"(?P<option>.*?)\s*(?P<vi>[=:])\s*(?P<value>.*)$")
+
+def createExclusive(filename,content):
+    # Create filename with content if it doesn't exist, returns False if it does
+    # content is written to a unique temporary file which is then hard linked to filename
+    # so the file is never seen partially written, os.link is atomic on local file systems and NFS
+    tmp = f'{filename}.{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}.tmp'
+    with open(tmp,'w') as f:
+        f.write(content)
+    try:
+        os.link(tmp,filename)
+        return(True)
+    except OSError:
+        # NFS can report an error for a link which succeeded, the link count of tmp tells
+        return(os.stat(tmp).st_nlink == 2)
+    finally:
+        os.remove(tmp)
+
+class shardLease():
+    # Lease on a shard of a sharded pre-processing run, held by one process at a time over a shared file system
+    # The lease file is created with createExclusive and touched every heartbeat seconds by a background thread
+    # A lease which hasn't been touched for leaseTimeout seconds (crashed or disconnected holder) is taken over by the next process
+    # Ages are measured against the mtime of a file touched by this process, so the clocks of the hosts don't need to agree
+    def __init__(self,leaseFile,heartbeat=30,leaseTimeout=300):
+        self.leaseFile = leaseFile
+        self.heartbeat = heartbeat
+        self.leaseTimeout = leaseTimeout
+        self.token = f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}'
+        self.stop = threading.Event()
+        self.thread = None
+        self.lost = False
+
+    def now(self):
+        # Current time on the file system
+        clock = f'{os.path.dirname(self.leaseFile)}/.clock_{self.token}'
+        with open(clock,'w') as f:
+            pass
+        now = os.stat(clock).st_mtime
+        os.remove(clock)
+        return(now)
+
+    def owner(self):
+        try:
+            with open(self.leaseFile) as f:
+                return(json.load(f)['owner'])
+        except (OSError,ValueError,KeyError):
+            return(None)
+
+    def acquire(self):
+        info = json.dumps({'owner':self.token,'host':socket.gethostname(),'pid':os.getpid()})
+        if createExclusive(self.leaseFile,info) == False:
+            try:
+                held = os.stat(self.leaseFile)
+            except FileNotFoundError:
+                # Released since, the shard is picked up on the next pass
+                return(False)
+            if self.now()-held.st_mtime < self.leaseTimeout:
+                return(False)
+            # Move the stale lease aside, only one process can rename it
+            stale = f'{self.leaseFile}.{self.token}.stale'
+            try:
+                os.rename(self.leaseFile,stale)
+            except FileNotFoundError:
+                return(False)
+            moved = os.stat(stale)
+            if (moved.st_ino,moved.st_mtime) != (held.st_ino,held.st_mtime):
+                # Another process took over the lease between the check and the rename, put it back
+                try:
+                    os.link(stale,self.leaseFile)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return(False)
+            os.remove(stale)
+            print(f'Taking over stale lease {os.path.basename(self.leaseFile)}')
+            if createExclusive(self.leaseFile,info) == False:
+                return(False)
+        self.thread = threading.Thread(target=self.beat,daemon=True)
+        self.thread.start()
+        return(True)
+
+    def beat(self):
+        while self.stop.wait(self.heartbeat) == False:
+            if self.owner() != self.token:
+                print(f'Lease {os.path.basename(self.leaseFile)} was taken over by another process')
+                self.lost = True
+                return
+            try:
+                os.utime(self.leaseFile)
+            except OSError:
+                self.lost = True
+                return
+
+    def held(self):
+        return(self.lost == False and self.owner() == self.token)
+
+    def complete(self,markerFile,info):
+        # Mark the shard complete if the lease is still held, the first process to complete a shard wins
+        if self.held() == False:
+            return(False)
+        return(createExclusive(markerFile,json.dumps(info)))
+
+    def release(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.owner() == self.token:
+            try:
+                os.remove(self.leaseFile)
+            except FileNotFoundError:
+                pass
+
+def parseMetaData(text):
+    # Lightweight parser for .metadata files (ini format) which replaces configparser in Parser.readMetaData
+    # Follows the configparser defaults: keys are lower case, values are stripped, lines starting with ; or # are comments
+    # and %% is unescaped to % (no other interpolation is done)
+    # Indented lines continue the previous value, section names, keys and values are interned so parsed files share strings
+    metaData = {}
+    section,key = None,None
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped == '' or stripped[0] in ';#':
+            continue
+        if line[0] in ' \t' and key is not None:
+            section[key] = sys.intern(section[key]+'\n'+stripped)
+        elif stripped.startswith('[') and stripped.endswith(']'):
+            section = metaData.setdefault(sys.intern(stripped[1:-1]),{})
+            key = None
+        elif section is not None:
+            match = metaDataOption.match(stripped)
+            if match and match.group('option') != '':
+                key = sys.intern(match.group('option').lower())
+                section[key] = sys.intern(match.group('value').replace('%%','%'))
+    return(metaData)
+
+class lruCache():
+    # Bounded least recently used cache
+    # Module level instances persist for the life of a worker process
+    def __init__(self,maxsize=64):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self,key):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return(self.items[key])
+        return(None)
+
+    def put(self,key,value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+# Parsed .metadata files, keyed by a hash of the raw bytes
+metaDataCache = lruCache()
+
+class streamingStats():
+    # Single pass aggregation kernel for the raw data, all enabled statistics are computed together for each block of rows
+    # Blocks (chunks of a file, or the whole file) are merged with the parallel algorithms of Chan et al. and Pebay (2008),
+    # so results match a full read; skew/kurt follow the bias adjusted pandas definitions, and central moments are only
+    # accumulated when a statistic which needs them (std/var, skew/kurt) is enabled
+    # median is approximated by the count-weighted median of the chunk medians (exact for a single block)
+    # fractionMissing: fraction of the expected records (acquisition_frequency x file_duration) missing from the file
+    # fractionNaN: fraction of the records with a NaN, inf or missing value code (intNaN) in the column
+    supported = ['mean','std','var','min','max','count','sum','median','skew','kurt','fractionMissing','fractionNaN']
+
+    def __init__(self,columns,agg=[],missingValue=None):
+        self.columns = columns
+        self.agg = agg
+        self.missingValue = missingValue
+        self.higher = 'skew' in agg or 'kurt' in agg
+        self.second = self.higher or 'std' in agg or 'var' in agg
+        self.rows = 0
+        self.n = np.zeros(len(columns))
+        self.mean = np.zeros(len(columns))
+        self.M2 = np.zeros(len(columns))
+        self.M3 = np.zeros(len(columns))
+        self.M4 = np.zeros(len(columns))
+        self.min = np.full(len(columns),np.inf)
+        self.max = np.full(len(columns),-np.inf)
+        self.medians = []
+        self.weights = []
+
+    def update(self,values,median=False):
+        valid = np.isfinite(values)
+        if self.missingValue is not None:
+            valid &= values != self.missingValue
+        n = valid.sum(axis=0)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            x = np.where(valid,values,0.0)
+            mean = x.sum(axis=0)/n
+            nA,nB = self.n,n
+            total = nA+nB
+            ix = n>0
+            delta = np.where(ix,mean-self.mean,0.0)
+            M2 = 0.0
+            if self.second:
+                d = np.where(valid,x-mean,0.0)
+                d2 = d*d
+                M2 = d2.sum(axis=0)
+            if self.higher:
+                M3 = (d2*d).sum(axis=0)
+                M4 = (d2*d2).sum(axis=0)
+                self.M4[ix] += (M4+delta**4*nA*nB*(nA**2-nA*nB+nB**2)/total**3
+                                +6*delta**2*(nA**2*M2+nB**2*self.M2)/total**2+4*delta*(nA*M3-nB*self.M3)/total)[ix]
+                self.M3[ix] += (M3+delta**3*nA*nB*(nA-nB)/total**2+3*delta*(nA*M2-nB*self.M2)/total)[ix]
+            if self.second:
+                self.M2[ix] += M2[ix]+delta[ix]**2*nA[ix]*nB[ix]/total[ix]
+            self.mean[ix] += delta[ix]*nB[ix]/total[ix]
+        self.n = total
+        self.rows += values.shape[0]
+        self.min = np.minimum(self.min,np.where(valid,values,np.inf).min(axis=0,initial=np.inf))
+        self.max = np.maximum(self.max,np.where(valid,values,-np.inf).max(axis=0,initial=-np.inf))
+        if median == True and values.shape[0]>0:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore',category=RuntimeWarning)
+                self.medians.append(np.nanmedian(np.where(valid,values,np.nan),axis=0))
+            self.weights.append(n)
+
+    def statistics(self,agg,expectedRecords=None):
+        # Dict of arrays (one value per column) for each statistic in agg
+        out = {}
+        n = self.n
+        empty = n == 0
+        with np.errstate(invalid='ignore',divide='ignore'):
+            out['count'] = n.astype(int)
+            out['sum'] = self.mean*n
+            out['mean'] = np.where(empty,np.nan,self.mean)
+            out['var'] = np.where(n>1,self.M2/(n-1),np.nan)
+            out['std'] = np.sqrt(out['var'])
+            if self.higher:
+                # Round off error in the second moment is treated as zero variance, as in pandas
+                M2 = np.where(np.abs(self.M2)<1e-14,0.0,self.M2)
+                skew = np.sqrt(n*(n-1))/(n-2)*(self.M3/n)/(M2/n)**1.5
+                out['skew'] = np.where(n<3,np.nan,np.where(M2==0,0.0,skew))
+                kurt = n*(n+1)*(n-1)*self.M4/((n-2)*(n-3)*M2**2)-3*(n-1)**2/((n-2)*(n-3))
+                out['kurt'] = np.where(n<4,np.nan,np.where(M2==0,0.0,kurt))
+            out['fractionNaN'] = np.full(len(self.columns),1-n/self.rows if self.rows>0 else np.nan)
+            missing = np.nan
+            if expectedRecords is not None and expectedRecords>0:
+                missing = min(max(1-self.rows/expectedRecords,0.0),1.0)
+            out['fractionMissing'] = np.full(len(self.columns),missing)
+        out['min'] = np.where(empty,np.nan,self.min)
+        out['max'] = np.where(empty,np.nan,self.max)
+        if 'median' in agg:
+            out['median'] = np.full(len(self.columns),np.nan)
+            if len(self.medians)>0:
+                medians,weights = np.array(self.medians),np.array(self.weights)
+                for i in range(medians.shape[1]):
+                    m,w = medians[:,i],weights[:,i]
+                    order = np.argsort(m[w>0])
+                    m,w = m[w>0][order],w[w>0][order]
+                    if w.sum()>0:
+                        out['median'][i] = m[np.searchsorted(np.cumsum(w),w.sum()/2)]
+        return({key:out[key] for key in agg})
+
+    def result(self,agg,expectedRecords=None):
+        # Statistics by column (rows = statistics), the layout of DataFrame.agg
+        return(pd.DataFrame(self.statistics(agg,expectedRecords),index=self.columns).T)
+
+    def row(self,agg,timestamp,keep=None,expectedRecords=None):
+        # Statistics as a single row for the timestamp, in the layout of Parser.formatAgg (columns: column levels + statistic)
+        # keep: mask of the columns to output
+        keep = np.ones(len(self.columns),dtype=bool) if keep is None else np.asarray(keep)
+        stats = sorted(agg)
+        out = self.statistics(agg,expectedRecords)
+        values = np.column_stack([out[stat][keep].astype(float) for stat in stats]) if len(stats)>0 else np.empty((keep.sum(),0))
+        columns = [c if type(c) == tuple else (c,) for c in self.columns[keep]]
+        columns = pd.MultiIndex.from_tuples([c+(stat,) for c in columns for stat in stats]) if len(columns)*len(stats)>0 else pd.MultiIndex.from_tuples([],names=[None]*(self.columns.nlevels+1))
+        return(pd.DataFrame(values.reshape(1,-1),index=pd.Index([timestamp],name='Timestamp'),columns=columns))
+
+class qcPrescreen():
+    # Raw data QC prescreen (see config.yml: monitoringInstructions>qcPrescreen), run on the blocks of rows read by the Parser
+    # Adds statistics to rawDataStatistics which dataFilters can use like the dataAggregation statistics (Vickers & Mahrt 1997):
+    #   spikes: fraction of the records more than spikeThreshold standard deviations from the mean of their window
+    #   emptyBins: amplitude resolution, largest fraction of empty bins in the histogram (mean +- 3.5 sd) of a window
+    #   dropouts: longest run of identical consecutive values (stuck sensor, dropout), as a fraction of the records
+    #   diagFail: for diagnostic words (columns with a variable listed in diagnostics), fraction of the records where the
+    #   checked bits (mask) are not as expected (good)
+    # Windows are windowLength seconds long (windowRows rows when the acquisition frequency is unknown), rows which
+    # don't fill a window are carried over to the next block so results don't depend on the block size
+    def __init__(self,columns,variables,settings,frequency=None,missingValue=None):
+        self.columns = columns
+        self.settings = settings
+        self.missingValue = missingValue
+        self.diagnostics = [settings['diagnostics'].get(v) for v in variables]
+        self.isDiag = np.array([d is not None for d in self.diagnostics],dtype=bool)
+        self.windowRows = max(int(settings['windowLength']*frequency) if frequency else int(settings['windowRows']),2)
+        self.carry = np.empty((0,len(columns)))
+        self.rows = 0
+        self.n = np.zeros(len(columns))
+        self.spikes = np.zeros(len(columns))
+        self.emptyBins = np.full(len(columns),np.nan)
+        self.maxRun = np.zeros(len(columns))
+        self.run = np.zeros(len(columns))
+        self.last = np.full(len(columns),np.nan)
+        self.diagFail = np.zeros(len(columns))
+
+    def update(self,values):
+        values = np.array(values,dtype=float)
+        valid = np.isfinite(values)
+        if self.missingValue is not None:
+            valid &= values != self.missingValue
+        values[~valid] = np.nan
+        self.rows += values.shape[0]
+        self.n += valid.sum(axis=0)
+        self.dropouts(values)
+        for j in np.where(self.isDiag)[0]:
+            mask,good = self.diagnostics[j]['mask'],self.diagnostics[j]['good']
+            words = values[valid[:,j],j].astype(np.int64)
+            self.diagFail[j] += ((words & mask) != good).sum()
+        # Full windows are tested now, the rest is carried over
+        block = np.vstack([self.carry,values]) if self.carry.shape[0]>0 else values
+        nWindows = block.shape[0]//self.windowRows
+        if nWindows>0:
+            self.windows(block[:nWindows*self.windowRows].reshape(nWindows,self.windowRows,-1))
+        self.carry = block[nWindows*self.windowRows:]
+
+    def windows(self,w):
+        # w: windows x rows x columns, NaN where invalid
+        k = self.settings['spikeThreshold']
+        nBins = self.settings['amplitudeBins']
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',category=RuntimeWarning)
+            mean = np.nanmean(w,axis=1,keepdims=True)
+            sd = np.nanstd(w,axis=1,keepdims=True)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                self.spikes += (np.abs(w-mean)>k*sd).sum(axis=(0,1))
+                bins = np.floor((w-(mean-3.5*sd))/(7*sd/nBins))
+            inRange = np.isfinite(bins)&(bins>=0)&(bins<nBins)
+            nWindows,nRows,nCols = w.shape
+            cell = (np.arange(nWindows)[:,None,None]*nCols+np.arange(nCols)[None,None,:])*nBins
+            counts = np.bincount((cell+np.where(inRange,bins,0)).astype(np.int64)[inRange],minlength=nWindows*nCols*nBins)
+            empty = (counts.reshape(nWindows,nCols,nBins) == 0).mean(axis=2)
+            n = np.isfinite(w).sum(axis=1)
+            # A constant signal (sd = 0) falls in a single bin
+            empty = np.where(sd[:,0,:] == 0,(nBins-1)/nBins,empty)
+            empty = np.where(n>1,empty,np.nan)
+            self.emptyBins = np.fmax(self.emptyBins,np.nanmax(empty,axis=0))
+
+    def dropouts(self,values):
+        # Longest run of identical consecutive values in each column, runs continue across blocks
+        for j in range(values.shape[1]):
+            v = values[:,j]
+            if v.shape[0] == 0:
+                continue
+            same = np.empty(v.shape[0],dtype=bool)
+            same[0] = v[0] == self.last[j]
+            same[1:] = v[1:] == v[:-1]
+            starts = np.flatnonzero(~same)
+            if starts.shape[0] == 0:
+                self.run[j] += v.shape[0]
+                self.maxRun[j] = max(self.maxRun[j],self.run[j])
+            else:
+                runs = np.diff(np.append(starts,v.shape[0]))
+                self.maxRun[j] = max(self.maxRun[j],self.run[j]+starts[0],runs.max())
+                self.run[j] = runs[-1]
+            self.last[j] = v[-1]
+
+    def statistics(self):
+        # The remaining rows are tested as a last (partial) window
+        if self.carry.shape[0]>1:
+            self.windows(self.carry[None])
+            self.carry = self.carry[:0]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            out = {
+                'spikes':np.where(self.n>0,self.spikes/self.n,np.nan),
+                'emptyBins':self.emptyBins,
+                'dropouts':np.where(self.rows>0,self.maxRun/max(self.rows,1),np.nan),
+                'diagFail':np.where(self.n>0,self.diagFail/self.n,np.nan)
+                }
+        return(out)
+
+    def row(self,timestamp,keep=None):
+        # Statistics as a single row for the timestamp, in the same layout as streamingStats.row
+        # diagnostic words only get diagFail, other columns get spikes, emptyBins, and dropouts
+        keep = np.ones(len(self.columns),dtype=bool) if keep is None else np.asarray(keep)
+        out = self.statistics()
+        columns,values = [],[]
+        for j,c in enumerate(self.columns):
+            if keep[j]:
+                for stat in (['diagFail'] if self.isDiag[j] else ['dropouts','emptyBins','spikes']):
+                    columns.append((c if type(c) == tuple else (c,))+(stat,))
+                    values.append(out[stat][j])
+        return(pd.DataFrame([values],index=pd.Index([timestamp],name='Timestamp'),
+                            columns=pd.MultiIndex.from_tuples(columns) if len(columns)>0 else None))
+
 class Parser():
-    def __init__(self,config=None,metaDataTemplate='None',debug=False):
+    # Number of outputs (excluding the pid) returned by readFile
+    nOut = 2
+
+    def __init__(self,config=None,metaDataTemplate='None',debug=False,lowMemory=False):
         if config is None:
             with open('config_files/config.yml') as yml:
                 self.config = yaml.safe_load(yml)
@@ -79,9 +693,17 @@ class Parser():
         else:
             self.config = config
         self.debug = debug
-        self.nOut = 2
+        self.lowMemory = lowMemory
+        metaDataCache.maxsize = self.config['metaDataCacheSize']
         # Define statistics to aggregate raw data by, see configuration
         self.agg = [key for key, value in self.config['monitoringInstructions']['dataAggregation'].items() if value is True]
+        # Statistics are computed by the streamingStats kernel, unless a statistic it doesn't support is requested
+        self.kernel = set(self.agg).issubset(streamingStats.supported)
+        # Records in a complete file, for fractionMissing (see recordsPerFile)
+        self.expectedRecords = None
+        # Optional raw data QC prescreen (see qcPrescreen), windows are set from the acquisition frequency of each file
+        self.qcSettings = self.config['monitoringInstructions'].get('qcPrescreen',{})
+        self.frequency = None
         if metaDataTemplate != 'None':
             self.metaDataTemplate = self.readMetaData(open(metaDataTemplate))
         else:
@@ -110,6 +732,8 @@ class Parser():
                     pass
         else:
             metaData = self.metaDataTemplate.copy()
+            self.frequency = self.acquisitionFrequency(metaData)
+            self.expectedRecords = self.recordsPerFile(metaData)
             d_agg, d_names = self.readData(filepath,metaData,timestamp)
             metaData.update(d_names)
         
@@ -123,6 +747,32 @@ class Parser():
         metaData.index.name = 'TIMESTAMP'
         return(os.getpid(),d_agg,metaData)
 
+    def recordsPerFile(self,metaData):
+        # Number of records in a complete file, from the acquisition frequency (Hz) and file duration (minutes)
+        try:
+            return(float(metaData[('Timing','acquisition_frequency')])*float(metaData[('Timing','file_duration')])*60)
+        except (KeyError,TypeError,ValueError):
+            return(None)
+
+    def acquisitionFrequency(self,metaData):
+        try:
+            return(float(metaData[('Timing','acquisition_frequency')]))
+        except (KeyError,TypeError,ValueError):
+            return(None)
+
+    def prescreen(self,columns,variables):
+        # qcPrescreen for the columns of a file (None when the prescreen is off)
+        # variables are the FileDescription variables of the columns, used to identify diagnostic words
+        if self.qcSettings.get('enabled',False) != True:
+            return(None)
+        return(qcPrescreen(columns,variables,self.qcSettings,self.frequency,self.config['intNaN']))
+
+    def addPrescreen(self,d_agg,qc,timestamp,keep=None):
+        # Append the prescreen statistics to the aggregation statistics of the file
+        if qc is None:
+            return(d_agg)
+        return(pd.concat([d_agg,qc.row(timestamp,keep)],axis=1))
+
     def extractGHG(self,filepath,timestamp):
         base = os.path.basename(filepath).rstrip('.ghg')
         ghgInventory = {}
@@ -131,32 +781,122 @@ class Parser():
             # Get all possible contents of ghg file, for now only concerned with .data and .metadata, can expand to biomet and config/calibration files later
             for f in subFiles:
                 ghgInventory[f.replace(base,'')]=f
-            with ghgZip.open(ghgInventory['.metadata']) as f:
-                metaData = self.readMetaData(TextIOWrapper(f, 'utf-8'))
-            if hasattr(self.pdKwargs, 'skiprows') == False:
+            metaData = self.readMetaData(ghgZip.read(ghgInventory['.metadata']))
+            self.frequency = self.acquisitionFrequency(metaData)
+            self.expectedRecords = self.recordsPerFile(metaData)
+            if 'skiprows' not in self.pdKwargs:
                 self.pdKwargs['skiprows'] = int(self.pdKwargs['header'])-1
                 self.pdKwargs['header'] = 0
-            with ghgZip.open(ghgInventory['.data']) as f:
-                d_agg, d_names = self.readData(f,metaData,timestamp)
+            # Try the column-pruned parser first, fall back to the generic parser if the file doesn't match the metadata
+            out = self.readGHGData(ghgZip,ghgInventory['.data'],timestamp)
+            if out is None:
+                with ghgZip.open(ghgInventory['.data']) as f:
+                    out = self.readData(f,metaData,timestamp)
+            d_agg, d_names = out
             metaData.update(d_names)
         return(d_agg,metaData)
 
+    def readGHGData(self,ghgZip,member,timestamp):
+        # Fast reader for the .data member of a .ghg file
+        # Only the columns which the FileDescription does not set to ignore or not_numeric are parsed, straight to float
+        # Uses the pyarrow csv engine if available, otherwise the pandas c engine with usecols
+        # Returns None if the header doesn't match the metadata or a column can't be parsed as float
+        try:
+            import pyarrow as pa
+            from pyarrow import csv
+        except ImportError:
+            pa = None
+        header_rows = int(self.fileDescription['header_rows'])
+        sep = self.config['delimiters'][self.fileDescription['separator']].encode('ascii','ignore').decode('unicode_escape')
+        with ghgZip.open(member) as f:
+            for i in range(header_rows):
+                header = f.readline()
+        header = header.decode('utf-8').rstrip('\r\n').split(sep)
+        offset = 1 if self.fileDescription['data_label'] != 'Not set' else 0
+        names = header[offset:]
+        unit_list = [value for key,value in self.fileDescription.items() if 'unit_in' in key]
+        if len(names) != len(unit_list) or len(set(names)) != len(names) or '' in names:
+            return(None)
+        self.ignore = [int(key.split('_')[1])-1 for key,value in self.fileDescription.items() if value == 'ignore']
+        use = [i for i in range(len(names)) if i not in self.ignore and self.fileDescription.get(f'col_{i+1}_variable') != 'not_numeric']
+        columns = pd.MultiIndex.from_arrays([[names[i] for i in use],[unit_list[i] for i in use]])
+        usecols = [i+offset for i in use]
+        naValues = [str(self.config['intNaN']),'','NaN','nan','NAN','-nan','NA','N/A','#N/A','null','NULL']
+        # lowMemory: blocks are merged into the statistics as they are read, otherwise the file is aggregated in one block
+        stream = self.lowMemory == True and self.kernel == True
+        chunks = []
+        stats = streamingStats(columns,self.agg,self.config['intNaN'])
+        qc = self.prescreen(columns,[self.fileDescription.get(f'col_{i+1}_variable') for i in use])
+        try:
+            with ghgZip.open(member) as f:
+                if pa is not None:
+                    colNames = [f'c{i}' for i in range(len(header))]
+                    readOptions = csv.ReadOptions(skip_rows=header_rows,column_names=colNames)
+                    parseOptions = csv.ParseOptions(delimiter=sep)
+                    convertOptions = csv.ConvertOptions(include_columns=[colNames[i] for i in usecols],
+                                                        column_types={colNames[i]:pa.float64() for i in usecols},
+                                                        null_values=naValues,strings_can_be_null=True)
+                    reader = csv.open_csv(f,read_options=readOptions,parse_options=parseOptions,convert_options=convertOptions)
+                    batches = (np.column_stack([c.to_numpy(zero_copy_only=False) for c in batch.columns]) if batch.num_columns>0 else np.empty((batch.num_rows,0)) for batch in reader)
+                else:
+                    reader = pd.read_csv(f,sep=sep,header=None,skiprows=header_rows,usecols=usecols,dtype=float,
+                                         na_values=naValues,chunksize=self.config['monitoringInstructions']['chunkSize'])
+                    batches = (chunk[usecols].to_numpy(dtype=float) for chunk in reader)
+                for values in batches:
+                    if qc is not None:
+                        qc.update(values)
+                    if stream == True:
+                        stats.update(values,'median' in self.agg)
+                    else:
+                        chunks.append(values)
+        except Exception as e:
+            if self.debug == True:
+                print(f'Fast parser failed for {member}, using generic parser: {e}')
+            return(None)
+        values = np.vstack(chunks) if len(chunks)>0 else np.empty((0,len(use)))
+        if self.kernel == True:
+            if stream == False:
+                stats.update(values,'median' in self.agg)
+            notNull = stats.n > 0
+        else:
+            values[np.isinf(values)] = np.nan
+            values[values == self.config['intNaN']] = np.nan
+            data = pd.DataFrame(values,columns=columns)
+            notNull = data.notna().any().values
+        # Columns which are all NaN are ignored
+        D1 = [use[j] for j in np.where(notNull==False)[0]]
+        self.ignore = self.ignore+D1
+        col_names = {('Custom',f'col_{i+1}_header_name'):c for i,c in enumerate(names)}
+        if self.kernel == True:
+            return(self.addPrescreen(stats.row(self.agg,timestamp,notNull,self.expectedRecords),qc,timestamp,notNull),col_names)
+        d_agg = data.loc[:,notNull].agg(self.agg)
+        return(self.addPrescreen(self.formatAgg(d_agg,timestamp),qc,timestamp,notNull),col_names)
+
     def readMetaData(self,metaDataFile):
         # Parse the .metadata file included in the .ghg file or defined by user
         # Extract file description to parse data and dump relevant metaData values to dataframe for tracking
-        metaData = configparser.ConfigParser()
-        metaData.read_file(metaDataFile)
-        metaData = {key:dict(metaData[key]) for key in metaData.keys()}
+        # Accepts raw bytes or a file object, consecutive files usually have identical metadata
+        # so the parsed (read-only) result is cached by a hash of the raw bytes and only new metadata are parsed
+        if type(metaDataFile) != bytes:
+            metaDataFile = metaDataFile.read()
+            if type(metaDataFile) == str:
+                metaDataFile = metaDataFile.encode('utf-8')
+        key = hashlib.blake2b(metaDataFile,digest_size=16).digest()
+        parsed = metaDataCache.get(key)
+        if parsed is None:
+            metaData = parseMetaData(metaDataFile.decode('utf-8'))
+            # Reformat for dumping to DataFrame
+            parsed = (MappingProxyType({(k1,k2):val for k1 in metaData.keys() for k2,val in metaData[k1].items()}),
+                      MappingProxyType(metaData['FileDescription']))
+            metaDataCache.put(key,parsed)
+        metaData,self.fileDescription = parsed
         # Parse info to be used as **kwarg in pd.read_csv()
         if hasattr(self,'pdKwargs') == False:
             self.pdKwargs = {}
-            self.pdKwargs['header'] = metaData['FileDescription']['header_rows']
-            self.pdKwargs['sep'] = self.config['delimiters'][metaData['FileDescription']['separator']].encode('ascii','ignore').decode('unicode_escape')
-        # Other info from metadata
-        self.fileDescription = metaData['FileDescription'].copy()
-        # Reformat for dumping to DataFrame        
-        metaData = {(k1,k2):val for k1 in metaData.keys() for k2,val in metaData[k1].items()}
-        return(metaData)
+            self.pdKwargs['header'] = self.fileDescription['header_rows']
+            self.pdKwargs['sep'] = self.config['delimiters'][self.fileDescription['separator']].encode('ascii','ignore').decode('unicode_escape')
+        # Return a copy, since the metaData are updated per file
+        return(dict(metaData))
     
     def readData(self,dataFile,metaData=None,timestamp=None):
         # read the raw high frequency data
@@ -169,6 +909,8 @@ class Parser():
             self.pdKwargs['index_col']=False
         if hasattr(self.pdKwargs,'na_values') == False:
             self.pdKwargs['na_values'] = self.config['intNaN']
+        if metaData is not None and self.lowMemory == True and self.kernel == True:
+            return(self.readDataChunks(dataFile,timestamp))
         with warnings.catch_warnings(record=True) as w:
             # Only capture the specific ParserWarning
             warnings.simplefilter("always", category=pd.errors.ParserWarning)
@@ -176,20 +918,7 @@ class Parser():
             if w and any(issubclass(warning.category, pd.errors.ParserWarning) for warning in w):
                 print("ParserWarning detected: Adjusting headers")
         if metaData is not None:
-            if self.fileDescription['data_label'] != 'Not set':
-                # .ghg data files contain a "DATA" label if first column which isn't needed
-                data = data.drop(data.columns[0],axis=1)
-            # Parse units from metadata if not included in headers
-            if type(self.pdKwargs['header']) != list or len(self.pdKwargs['header']) == 1:
-                unit_list = [value for key,value in self.fileDescription.items() if 'unit_in' in key]
-                try:
-                    data.columns = [data.columns,unit_list]
-                except:
-                    data = data.dropna(how='all',axis=1).copy()
-                    data.columns = [data.columns,unit_list]
-                    if self.debug == True:
-                        print(f'Dropped NaN columns in {dataFile.name} to force metadata match')
-                    pass
+            data,_ = self.formatColumns(data,dataFile)
             self.ignore = [int(key.split('_')[1])-1 for key,value in self.fileDescription.items() if value == 'ignore']
             D1 = data.columns[data.isna().all()].tolist()
             self.ignore = self.ignore+ [i for i,c in enumerate(data.columns) if c in D1 and i not in self.ignore]
@@ -197,22 +926,483 @@ class Parser():
             col_names = {}
             for i,c in enumerate(data.columns.get_level_values(0)):
                 col_names[('Custom',f'col_{i+1}_header_name')] = c
+            variables = {c:self.fileDescription.get(f'col_{i+1}_variable') for i,c in enumerate(data.columns)}
             # Generate the aggregation statistics, but only for numeric columns that are not being ignored
             to_drop = [data.columns[i] for i in self.ignore]
             data = data.drop(to_drop,axis=1)
             data = data._get_numeric_data()
+            qc = self.prescreen(data.columns,[variables[c] for c in data.columns])
+            if qc is not None:
+                qc.update(data.to_numpy(dtype=float))
+            if self.kernel == True:
+                stats = streamingStats(data.columns,self.agg,self.config['intNaN'])
+                stats.update(data.to_numpy(dtype=float),'median' in self.agg)
+                return(self.addPrescreen(stats.row(self.agg,timestamp,expectedRecords=self.expectedRecords),qc,timestamp),col_names)
             data.replace([np.inf, -np.inf], np.nan, inplace=True)
             d_agg = data.agg(self.agg)
-            d_agg['Timestamp'] = timestamp
-            d_agg.set_index('Timestamp', append=True, inplace=True)
-            d_agg = d_agg.reorder_levels(['Timestamp',None]).unstack()
-            return(d_agg,col_names)
+            return(self.addPrescreen(self.formatAgg(d_agg,timestamp),qc,timestamp),col_names)
         else:
             return(data)
 
+    def readDataChunks(self,dataFile,timestamp=None):
+        # lowMemory alternative to readData, reads the file in chunks of chunkSize rows (see config.yml)
+        # and merges the partial aggregates so peak memory is independent of the file length
+        # Columns which are all NaN can only be identified after the last chunk, they are added to self.ignore at the end
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always", category=pd.errors.ParserWarning)
+            reader = pd.read_csv(dataFile,chunksize=self.config['monitoringInstructions']['chunkSize'],**self.pdKwargs)
+            first = next(reader)
+            offset = 1 if self.fileDescription['data_label'] != 'Not set' else 0
+            data,keep = self.formatColumns(first,dataFile)
+            columns = data.columns
+            self.ignore = [int(key.split('_')[1])-1 for key,value in self.fileDescription.items() if value == 'ignore']
+            use = [c for i,c in enumerate(columns) if i not in self.ignore]
+            numeric = data[use]._get_numeric_data().columns
+            stats = streamingStats(numeric,self.agg,self.config['intNaN'])
+            qc = self.prescreen(numeric,[self.fileDescription.get(f'col_{columns.get_loc(c)+1}_variable') for c in numeric])
+            notNull = np.zeros(len(columns),dtype=bool)
+            median = 'median' in self.agg
+            while data is not None:
+                notNull |= data.notna().any().values
+                values = data[numeric]
+                if (values.dtypes == object).any():
+                    values = values.apply(pd.to_numeric,errors='coerce')
+                values = values.to_numpy(dtype=float)
+                stats.update(values,median)
+                if qc is not None:
+                    qc.update(values)
+                chunk = next(reader,None)
+                if chunk is None:
+                    data = None
+                else:
+                    data = chunk.iloc[:,offset:]
+                    if keep is not None:
+                        data = data.loc[:,keep]
+                    data.columns = columns
+            if w and any(issubclass(warning.category, pd.errors.ParserWarning) for warning in w):
+                print("ParserWarning detected: Adjusting headers")
+        D1 = [int(i) for i in np.where(notNull==False)[0] if i not in self.ignore]
+        self.ignore = self.ignore+D1
+        col_names = {}
+        for i,c in enumerate(columns.get_level_values(0)):
+            col_names[('Custom',f'col_{i+1}_header_name')] = c
+        dropped = [columns[i] for i in D1]
+        keep = [c not in dropped for c in numeric]
+        return(self.addPrescreen(stats.row(self.agg,timestamp,keep,self.expectedRecords),qc,timestamp,keep),col_names)
+
+    def formatColumns(self,data,dataFile):
+        # Drop the data label and parse units from metadata if not included in headers
+        # Returns the formatted data and the mask of columns kept (None if all were kept)
+        keep = None
+        if self.fileDescription['data_label'] != 'Not set':
+            # .ghg data files contain a "DATA" label if first column which isn't needed
+            data = data.drop(data.columns[0],axis=1)
+        if type(self.pdKwargs['header']) != list or len(self.pdKwargs['header']) == 1:
+            unit_list = [value for key,value in self.fileDescription.items() if 'unit_in' in key]
+            try:
+                data.columns = [data.columns,unit_list]
+            except:
+                keep = data.notna().any().values
+                data = data.loc[:,keep].copy()
+                data.columns = [data.columns,unit_list]
+                if self.debug == True:
+                    print(f'Dropped NaN columns in {dataFile.name} to force metadata match')
+                pass
+        return(data,keep)
+
+    def formatAgg(self,d_agg,timestamp):
+        # Reshape the aggregation statistics to a single row for the timestamp
+        d_agg['Timestamp'] = timestamp
+        d_agg.set_index('Timestamp', append=True, inplace=True)
+        d_agg = d_agg.reorder_levels(['Timestamp',None]).unstack()
+        return(d_agg)
+
+# Parser for each worker process of the readFiles pool, built once by initParser
+workerParser = None
+# Trace directory of the run (None when tracing is off), see HelperFunctions.stageTracer
+workerTraceDir = None
+
+def initParser(config,metaDataTemplate,debug,lowMemory,traceDir=None):
+    global workerParser,workerTraceDir
+    workerParser = Parser(config,metaDataTemplate,debug=debug,lowMemory=lowMemory)
+    workerTraceDir = traceDir
+
+def readFileWorker(file):
+    with processTracer(workerTraceDir).span(os.path.basename(file[1]),'file'):
+        return(workerParser.readFile(file))
+
+def boundedTasks(items,window,stop=None):
+    # Yield tasks to a pool only when the window (a semaphore released as results are consumed) has room
+    # Runs in the task handler thread of the pool, setting stop ends the tasks so the pool can be terminated
+    for item in items:
+        while window.acquire(timeout=1) == False:
+            if stop is not None and stop.is_set():
+                return
+        if stop is not None and stop.is_set():
+            return
+        yield(item)
+
+def copyFile(source,dest):
+    # Copy a file in kernel space where supported (copy_file_range, then sendfile), the size of the copy is verified
+    size = os.path.getsize(source)
+    with open(source,'rb') as fsrc, open(dest,'wb') as fdst:
+        copied = 0
+        for method in ['copy_file_range','sendfile']:
+            if not hasattr(os,method):
+                continue
+            try:
+                while copied < size:
+                    if method == 'copy_file_range':
+                        n = os.copy_file_range(fsrc.fileno(),fdst.fileno(),size-copied)
+                    else:
+                        n = os.sendfile(fdst.fileno(),fsrc.fileno(),copied,size-copied)
+                    if n == 0:
+                        break
+                    copied += n
+                break
+            except OSError:
+                if copied > 0:
+                    raise
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc,fdst,2**20)
+    shutil.copystat(source,dest)
+    if os.path.getsize(dest) != size:
+        raise OSError(f'Incomplete copy of {source} to {dest}')
+
+def publishDirectory(source,dest,threads=8):
+    # Move the contents of source to dest, dest appears complete or not at all (published by renaming from dest.partial)
+    # Uses a rename when source and dest are on the same filesystem, otherwise the files are copied in parallel
+    staging = dest+'.partial'
+    shutil.rmtree(staging,ignore_errors=True)
+    os.makedirs(os.path.dirname(dest),exist_ok=True)
+    try:
+        os.rename(source,staging)
+    except OSError:
+        toCopy = []
+        for root,dirs,files in os.walk(source):
+            os.makedirs(root.replace(source,staging,1),exist_ok=True)
+            toCopy += [(f"{root}/{f}",f"{root.replace(source,staging,1)}/{f}") for f in files]
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda f: copyFile(*f),toCopy))
+        shutil.rmtree(source)
+    os.rename(staging,dest)
+
+def mergeCSV(toMerge,outFile,header=[0],parse_dates=[0],date_format=None,sep=',',blockSize=2**20):
+    # Merge csv files with identical headers into outFile, rows are ordered by the timestamp in the parse_dates column(s)
+    # Files which are time sorted and do not overlap (e.g., rp batches) are copied block by block without parsing the rows
+    # Falls back to a k-way merge of the rows when files overlap
+    # Returns False if the headers do not match (the files need to be merged by column)
+    # When none of the files have data rows the header of the first is written on its own
+    header = [header] if type(header) == int else header
+    parse_dates = [parse_dates] if type(parse_dates) == int else parse_dates
+    nHeader = max(header)+1
+    sep = sep.encode()
+    def timestamp(line):
+        values = line.rstrip(b'\r\n').split(sep)
+        text = ' '.join(values[i].decode().strip('"') for i in parse_dates)
+        return(datetime.datetime.strptime(text,date_format) if date_format else pd.Timestamp(text).to_pydatetime())
+    files = []
+    emptyHeader = None
+    for fn in toMerge:
+        with open(fn,'rb') as f:
+            head = [f.readline() for i in range(nHeader)]
+            offset = f.tell()
+            first = f.readline()
+            if first.strip() == b'':
+                if emptyHeader is None and all(h.strip() != b'' for h in head):
+                    emptyHeader = head
+                continue
+            # Read the last line from the end of the file
+            size = f.seek(0,os.SEEK_END)
+            f.seek(max(offset,size-blockSize))
+            last = [l for l in f.read().splitlines() if l.strip() != b''][-1]
+        files.append({'name':fn,'header':head,'offset':offset,'first':timestamp(first),'last':timestamp(last)})
+    if any(f['header'] != files[0]['header'] for f in files):
+        return(False)
+    files = sorted(files,key=lambda f: f['first'])
+    overlap = any(b['first'] <= a['last'] for a,b in zip(files[:-1],files[1:]))
+    with open(outFile+'.tmp','wb') as out:
+        if len(files)>0:
+            out.writelines(files[0]['header'])
+        elif emptyHeader is not None:
+            out.writelines(l if l.endswith(b'\n') else l+b'\n' for l in emptyHeader)
+        if overlap == False:
+            for f in files:
+                with open(f['name'],'rb') as data:
+                    data.seek(f['offset'])
+                    shutil.copyfileobj(data,out,blockSize)
+                    # Make sure each file ends with a line break before the next is appended
+                    data.seek(-1,os.SEEK_END)
+                    if data.read(1) != b'\n':
+                        out.write(b'\n')
+        else:
+            handles = [open(f['name'],'rb') for f in files]
+            try:
+                for f,h in zip(files,handles):
+                    h.seek(f['offset'])
+                rows = [((timestamp(line),line if line.endswith(b'\n') else line+b'\n') for line in h if line.strip() != b'') for h in handles]
+                out.writelines(line for t,line in heapq.merge(*rows,key=lambda r: r[0]))
+            finally:
+                for h in handles:
+                    h.close()
+    os.replace(outFile+'.tmp',outFile)
+    return(True)
+
+class eddyProTemplate():
+    # .eddypro settings of a group, merged once from the layers used by makeBatch (later layers take precedence):
+    #   static template < group column definitions < dynamic (eval) expressions < user defined settings
+    # Options are those of the static template, written in the same format as configparser.write
+    # Dynamic expressions which only refer to names in groupNames (and make no calls) are evaluated once,
+    # the others (dates, paths, project IDs, last_change_date ...) are slots filled by render for each batch
+    def __init__(self,static,columns,dynamic,user,scope,groupNames):
+        self.scope = scope
+        self.groupNames = groupNames
+        # The file is rendered as literals[0]+slot[0]+literals[1]+ ... +slot[n-1]+literals[n]
+        self.literals = []
+        self.slots = []
+        text = ''
+        for section in static.keys():
+            options = static[section].items()
+            if len(options) == 0:
+                continue
+            text += f"[{section}]\n"
+            for option,value in options:
+                slot = None
+                if columns.has_section(section) and columns.has_option(section, option):
+                    value = columns[section][option]
+                if dynamic.has_section(section) and dynamic.has_option(section, option):
+                    expression = dynamic[section][option]
+                    if self.isGroupLevel(expression):
+                        value = eval(expression,scope,groupNames).replace('\\','/')
+                    else:
+                        slot = expression
+                if section in user.keys() and option in user[section].keys():
+                    value,slot = str(user[section][option]),None
+                if slot is None:
+                    text += f"{option}={str(value).replace(chr(10),chr(10)+chr(9))}\n"
+                else:
+                    self.literals.append(text+f"{option}=")
+                    self.slots.append(self.compileSlot(slot))
+                    text = "\n"
+            text += "\n"
+        self.literals.append(text)
+
+    def isGroupLevel(self,expression):
+        tree = ast.parse(expression.strip(),mode='eval')
+        names = [node.id for node in ast.walk(tree) if isinstance(node,ast.Name)]
+        calls = [node for node in ast.walk(tree) if isinstance(node,ast.Call)]
+        return(len(calls) == 0 and all(name in self.groupNames for name in names))
+
+    def compileSlot(self,expression):
+        # Bare names are looked up directly, other expressions are compiled once
+        expression = expression.strip()
+        if expression.isidentifier():
+            return(expression)
+        return(compile(expression,'<eddyProDynamicConfig>','eval'))
+
+    def render(self,batchNames):
+        # Text of the .eddypro file (without the ;EDDYPRO_PROCESSING line) for the names of a batch
+        names = None
+        out = [self.literals[0]]
+        for slot,literal in zip(self.slots,self.literals[1:]):
+            if type(slot) == str:
+                value = batchNames[slot] if slot in batchNames else eval(slot,self.scope,self.groupNames)
+            else:
+                if names is None:
+                    names = self.groupNames | batchNames
+                value = eval(slot,self.scope,names)
+            out += [value.replace('\\','/').replace('\n','\n\t'),literal]
+        return(''.join(out))
+
+class rpCache():
+    # Cache of the outputs of eddypro_rp batches, stored in cacheDir/<fingerprint>/ with a manifest.json
+    # The fingerprint covers the .eddypro settings (minus run specific paths and dates), the group .metadata file,
+    # the eddypro_rp binary, the rows of the biomet and dynamic metadata files within the processing window,
+    # and the (filename, source, size, mtime) of every raw file staged for the batch
+    # Entries are evicted least recently used first once the cache exceeds maxSize (GB)
+    volatile = ['creation_date','last_change_date','file_name','project_title','project_id','proj_file',
+                'out_path','data_path','ex_file','sa_bin_spectra','sa_full_spectra']
+    # Per-timestamp outputs (e.g., cospectra) are named by the start of the averaging period
+    timestampPattern = re.compile(r'^([0-9]{8}-[0-9]{4})_')
+    # Timestamp at the start of a row of a biomet (e.g., 2024-01-31 1330) or dynamic metadata (e.g., 2024-01-31,13:30) file
+    rowPattern = re.compile(rb'^\s*"?([0-9]{4})[-/]?([0-9]{2})[-/]?([0-9]{2})[^0-9]{1,3}([0-9]{2}):?([0-9]{2})')
+    # Biomet and dynamic metadata files (or directories) read by eddypro_rp
+    auxiliaryInputs = ['biom_file','biom_dir','dyn_metadata_file']
+
+    def __init__(self,cacheDir,maxSize):
+        self.cacheDir = os.path.abspath(cacheDir)
+        self.maxSize = maxSize*1e9
+        # Digests of the eddypro_rp binaries by epRoot, see binaryDigest
+        self.binaries = {}
+        os.makedirs(self.cacheDir,exist_ok=True)
+
+    def binaryDigest(self,epRoot):
+        # Hashed once per run, call from the main process so the digest is sent to the workers with the instance
+        if epRoot not in self.binaries:
+            h = hashlib.blake2b(digest_size=20)
+            for fn in sorted(glob.glob(f"{epRoot}/eddypro_rp*")):
+                with open(fn,'rb') as f:
+                    for block in iter(lambda: f.read(2**20),b''):
+                        h.update(block)
+            self.binaries[epRoot] = h.hexdigest()
+        return(self.binaries[epRoot])
+
+    def auxiliaryFiles(self,settings):
+        # Biomet and dynamic metadata files named in the .eddypro settings
+        files = []
+        for option in self.auxiliaryInputs:
+            path = settings['Project'].get(option,'')
+            if path == '':
+                continue
+            if option == 'biom_dir' and os.path.isdir(path):
+                ext = settings['Project'].get('biom_ext','.txt').lstrip('*')
+                recurse = settings['Project'].get('biom_rec','0') == '1'
+                files += sorted(glob.glob(f"{path}/**/*{ext}" if recurse else f"{path}/*{ext}",recursive=recurse))
+            elif os.path.isfile(path):
+                files.append(path)
+        return(files)
+
+    def windowRows(self,fn,start,end,h):
+        # Add the rows of fn without a timestamp (headers) and the rows within start-end to h
+        # plus the nearest row either side, which eddypro_rp may use to fill the first and last averaging periods
+        before = None
+        with open(fn,'rb') as f:
+            for line in f:
+                match = self.rowPattern.match(line)
+                try:
+                    timestamp = datetime.datetime(*map(int,match.groups())) if match else None
+                except ValueError:
+                    timestamp = None
+                if timestamp is None:
+                    h.update(line)
+                elif timestamp < start:
+                    before = line
+                else:
+                    if before is not None:
+                        h.update(before)
+                        before = None
+                    h.update(line)
+                    if timestamp > end:
+                        break
+        if before is not None:
+            h.update(before)
+
+    def fingerprint(self,eddyproFile,files,epRoot):
+        settings = configparser.ConfigParser()
+        settings.read(eddyproFile)
+        h = hashlib.blake2b(digest_size=20)
+        for section in settings.sections():
+            for option,value in settings[section].items():
+                if option not in self.volatile:
+                    h.update(f"[{section}]{option}={value}\n".encode())
+        if os.path.isfile(settings['Project']['proj_file']):
+            with open(settings['Project']['proj_file'],'rb') as f:
+                h.update(hashlib.blake2b(f.read()).digest())
+        h.update(self.binaryDigest(epRoot).encode())
+        window = [datetime.datetime.strptime(settings['Project'][f'pr_{e}_date']+' '+settings['Project'][f'pr_{e}_time'],'%Y-%m-%d %H:%M')
+                  for e in ['start','end']]
+        for fn in self.auxiliaryFiles(settings):
+            h.update(f"{os.path.abspath(fn)}\n".encode())
+            self.windowRows(fn,window[0],window[1],h)
+        for filename,source in files[['filename','source']].values:
+            stat = os.stat(source)
+            h.update(f"{filename}|{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+        return(h.hexdigest())
+
+    def outputs(self,outDir,project_id,start,end):
+        # Relative paths of the outputs in outDir which belong to the batch project_id
+        # Files named for the project, or files in subdirectories named by a timestamp within the processing window
+        found = []
+        for root,dirs,files in os.walk(outDir):
+            rel = os.path.relpath(root,outDir)
+            if rel == '.':
+                # Skip the working directories of the batches (named by process ID)
+                dirs[:] = [d for d in dirs if not d.isdigit()]
+            for name in files:
+                match = self.timestampPattern.search(name)
+                if f"eddypro_{project_id}_" in name or (rel != '.' and match and
+                    start <= datetime.datetime.strptime(match.group(1),'%Y%m%d-%H%M') <= end):
+                    found.append(os.path.normpath(f"{rel}/{name}"))
+        return(found)
+
+    def store(self,key,eddyproFile,outDir,logFile):
+        settings = configparser.ConfigParser()
+        settings.read(eddyproFile)
+        project_id = settings['Project']['project_id']
+        window = [datetime.datetime.strptime(settings['Project'][f'pr_{e}_date']+' '+settings['Project'][f'pr_{e}_time'],'%Y-%m-%d %H:%M')
+                  for e in ['start','end']]
+        found = self.outputs(outDir,project_id,window[0],window[1])
+        # Only cache batches which produced outputs under their project name
+        if not any(f"eddypro_{project_id}_" in fn for fn in found):
+            return
+        entry = f"{self.cacheDir}/{key}"
+        tmp = f"{entry}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp,ignore_errors=True)
+        for fn in found:
+            os.makedirs(os.path.dirname(f"{tmp}/files/{fn}"),exist_ok=True)
+            shutil.copy2(f"{outDir}/{fn}",f"{tmp}/files/{fn}")
+        if os.path.isfile(logFile):
+            shutil.copy2(logFile,f"{tmp}/log.txt")
+        size = sum(os.path.getsize(f"{tmp}/files/{fn}") for fn in found)
+        with open(f"{tmp}/manifest.json",'w') as f:
+            json.dump({'project_id':project_id,'size':size,'files':found},f)
+        if os.path.isdir(entry):
+            shutil.rmtree(tmp,ignore_errors=True)
+        else:
+            os.replace(tmp,entry)
+        self.evict()
+
+    def restore(self,key,eddyproFile,outDir,logFile):
+        # Copy the cached outputs to outDir, renamed for the current project_id, returns False on a cache miss
+        entry = f"{self.cacheDir}/{key}"
+        try:
+            with open(f"{entry}/manifest.json") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError,json.JSONDecodeError):
+            return(False)
+        settings = configparser.ConfigParser()
+        settings.read(eddyproFile)
+        project_id = settings['Project']['project_id']
+        for fn in manifest['files']:
+            dest = f"{outDir}/{fn}".replace(f"eddypro_{manifest['project_id']}_",f"eddypro_{project_id}_")
+            os.makedirs(os.path.dirname(dest),exist_ok=True)
+            shutil.copy2(f"{entry}/files/{fn}",dest)
+        if os.path.isfile(f"{entry}/log.txt"):
+            shutil.copy2(f"{entry}/log.txt",logFile)
+        # Mark as recently used
+        os.utime(f"{entry}/manifest.json")
+        return(True)
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.cacheDir):
+            try:
+                with open(f"{self.cacheDir}/{key}/manifest.json") as f:
+                    entries.append((os.path.getmtime(f"{self.cacheDir}/{key}/manifest.json"),json.load(f)['size'],key))
+            except (FileNotFoundError,NotADirectoryError,json.JSONDecodeError):
+                pass
+        total = sum(e[1] for e in entries)
+        for mtime,size,key in sorted(entries):
+            if total <= self.maxSize:
+                break
+            shutil.rmtree(f"{self.cacheDir}/{key}",ignore_errors=True)
+            total -= size
+
 class runEddyPro():
-    def __init__(self,epRoot,subsetNames=['1'],priority = 'normal',debug=False):
+    def __init__(self,epRoot,subsetNames=['1'],priority = 'normal',debug=False,cache=None,staging='link',affinity=None,traceDir=None):
         self.epRoot = os.path.abspath(epRoot)
+        # Batches are traced from the worker processes when a trace directory is given
+        self.traceDir = traceDir
+        # How raw files are staged in hfData (see stageFile), link or copy
+        self.staging = staging
+        # CPUs the EddyPro processes are restricted to (POSIX only)
+        self.affinity = affinity
+        # Optional rpCache, batches with a matching fingerprint are restored instead of re-running eddypro_rp
+        self.cache = cache
+        if self.cache is not None:
+            self.cache.binaryDigest(self.epRoot)
         self.priority = priority
         self.debug = debug
         self.tempDir = {}
@@ -226,50 +1416,102 @@ class runEddyPro():
             os.makedirs(self.tempDir[f"{subsetName}"],exist_ok=True)
 
     def rpRun(self,toRun):
-        bin,toRun,dpth = self.setUp(toRun)
-        runEddyPro_rp=os.path.abspath(f'{bin}/runEddyPro_rp.bat')
-        with open(runEddyPro_rp, 'w') as batch:
-            contents = f'cd {bin}'
-            P = self.priority.lower().replace(' ','')
-            contents+='\nSTART powershell  ".\\eddypro_rp.exe | tee rp_processing_log.txt"'
-            contents+='\nping 127.0.0.1 -n 6 > nul'
-            contents+=f'\nwmic process where name="eddypro_rp.exe" CALL setpriority "{self.priority}"'
-            contents+='\nping 127.0.0.1 -n 6 > nul'
-            contents+='\nEXIT'
-            batch.write(contents)
-
-        subprocess.run(['cmd', '/c', runEddyPro_rp], capture_output=True)
-
-        pasteWithSubprocess(
-            os.path.abspath(f'{bin}/rp_processing_log.txt'),
-            os.path.abspath(toRun.replace('.eddypro','_log.txt'))
-        )
-
-        if self.debug == False:
-            shutil.rmtree(dpth)
-        return(os.path.split(bin)[0])
+        with processTracer(self.traceDir).span(os.path.basename(toRun[0]),'batch',files=len(toRun[1])):
+            if self.cache is not None:
+                eddyproFile = os.path.abspath(toRun[0])
+                settings = configparser.ConfigParser()
+                settings.read(eddyproFile)
+                outDir = settings['Project']['out_path']
+                logFile = eddyproFile.replace('.eddypro','_log.txt')
+                key = self.cache.fingerprint(eddyproFile,toRun[1],self.epRoot)
+                if self.cache.restore(key,eddyproFile,outDir,logFile):
+                    os.remove(eddyproFile)
+                    return('',0,0.0)
+            bin,toRun,dpth = self.setUp(toRun)
+            returncode,wallTime = self.execute(bin,'rp')
+            self.copyLog(bin,'rp',toRun)
+
+            if self.cache is not None and returncode == 0:
+                self.cache.store(key,f"{os.path.dirname(bin)}/ini/processing.eddypro",outDir,logFile)
+
+            if self.debug == False:
+                shutil.rmtree(dpth)
+            return(os.path.split(bin)[0],returncode,wallTime)
     
     def fccRun(self,toRun):
         bin,toRun,dpth = self.setUp(toRun)
-        runEddyPro_fcc=os.path.abspath(f'{bin}/runEddyPro_fcc.bat')
-        with open(runEddyPro_fcc, 'w') as batch:
-            contents = f'cd {bin}'
-            P = self.priority.lower().replace(' ','')
-            contents+='\nSTART powershell  ".\\eddypro_fcc.exe | tee fcc_processing_log.txt"'
-            contents+='\nping 127.0.0.1 -n 6 > nul'
-            contents+=f'\nwmic process where name="eddypro_fcc.exe" CALL setpriority "{self.priority}"'
-            contents+='\nping 127.0.0.1 -n 6 > nul'
-            contents+='\nEXIT'
-            batch.write(contents)
-
-        subprocess.run(['cmd', '/c', runEddyPro_fcc], capture_output=True)
-
-        pasteWithSubprocess(
-            os.path.abspath(f'{bin}/fcc_processing_log.txt'),
-            os.path.abspath(toRun.replace('.eddypro','_log.txt'))
-        )
-        return(os.path.split(bin)[0])
+        returncode,wallTime = self.execute(bin,'fcc')
+        self.copyLog(bin,'fcc',toRun)
+        return(os.path.split(bin)[0],returncode,wallTime)
+
+    def copyLog(self,bin,mode,toRun):
+        # Save the processing log alongside the .eddypro file, EddyPro may not write one if it fails to start
+        log = os.path.abspath(f'{bin}/{mode}_processing_log.txt')
+        if os.path.isfile(log):
+            shutil.copyfile(log,os.path.abspath(toRun.replace('.eddypro','_log.txt')))
+        else:
+            print(f'Warning: no {mode} processing log found for {toRun}')
 
+    def rpMerge(self,subsetName,ex_file,rpIntermediary):
+        # Merge the intermediary outputs of all rp batches in a group, saved alongside the ex_file used by the fcc run
+        for filePattern,kwargs in rpIntermediary.items():
+            kwargs = kwargs.copy()
+            fn = ex_file.replace('fluxnet',filePattern)
+            search_path = os.path.abspath(f"{self.tempDir[subsetName]}/**{filePattern}**.csv")
+            toMerge = [f for f in glob.glob(search_path) if os.path.abspath(f) != os.path.abspath(fn)]
+            if len(toMerge)>0:
+                print('Saving As \n',fn)
+                # Stream the rows of the batch files when the headers match, otherwise merge by column
+                if mergeCSV(toMerge,fn,kwargs['header'],kwargs['parse_dates'],kwargs.get('date_format')):
+                    continue
+                if 'parse_dates' in kwargs and type(kwargs['parse_dates'])==list:
+                    val = kwargs['parse_dates']
+                    key = tuple(['datetime']+['' for i in range(len(kwargs['header'])-1)])
+                    kwargs['parse_dates'] = {key:val}
+                Temp = pd.concat([pd.read_csv(f,**kwargs) for f in toMerge])
+                Temp = Temp.set_index(list(kwargs['parse_dates'].keys())[0]).sort_index()
+                Temp.to_csv(fn,index=False)
+
+    def fccGroup(self,toRun):
+        # Final step for a group, once all of its rp batches are complete: merge the rp outputs and run fcc
+        subsetName,fcc,ex_file,rpIntermediary = toRun
+        with processTracer(self.traceDir).span(os.path.basename(fcc),'batch'):
+            with processTracer(self.traceDir).span(f'{subsetName}_rpMerge','batch'):
+                self.rpMerge(subsetName,ex_file,rpIntermediary)
+            return(self.fccRun(fcc))
+
+    def execute(self,bin,mode):
+        # Run eddypro_rp or eddypro_fcc (mode = rp or fcc) from bin, output is logged to {mode}_processing_log.txt
+        # Returns the exit status and wall time (seconds) of the run
+        T1 = time.time()
+        if sys.platform.startswith("win"):
+            runEddyPro=os.path.abspath(f'{bin}/runEddyPro_{mode}.bat')
+            with open(runEddyPro, 'w') as batch:
+                contents = f'cd {bin}'
+                P = self.priority.lower().replace(' ','')
+                contents+=f'\nSTART powershell  ".\\eddypro_{mode}.exe | tee {mode}_processing_log.txt"'
+                contents+='\nping 127.0.0.1 -n 6 > nul'
+                contents+=f'\nwmic process where name="eddypro_{mode}.exe" CALL setpriority "{self.priority}"'
+                contents+='\nping 127.0.0.1 -n 6 > nul'
+                contents+='\nEXIT'
+                batch.write(contents)
+
+            proc = subprocess.run(['cmd', '/c', runEddyPro], capture_output=True)
+            returncode = proc.returncode
+        else:
+            # Launch EddyPro directly, stdout/stderr are streamed to the log as the run progresses
+            system = 'mac' if sys.platform.startswith("darwin") else 'linux'
+            batchRoot = os.path.dirname(bin)
+            with open(f'{bin}/{mode}_processing_log.txt','w') as log:
+                proc = subprocess.Popen(
+                    [os.path.abspath(f'{bin}/eddypro_{mode}'),'-s',system,'-e',batchRoot,f'{batchRoot}/ini/processing.eddypro'],
+                    cwd=bin,stdout=log,stderr=subprocess.STDOUT,
+                    preexec_fn=lambda: set_posix_priority(self.priority,self.affinity))
+                returncode = proc.wait()
+        wallTime = time.time()-T1
+        if returncode != 0:
+            print(f'Warning, eddypro_{mode} exited with status {returncode} in {bin}')
+        return(returncode,wallTime)
 
     def setUp(self,toRun):
         if type(toRun) != str:
@@ -304,8 +1546,10 @@ class runEddyPro():
             eddypro.write(';EDDYPRO_PROCESSING\n')
             epFile.write(eddypro,space_around_delimiters=False)
         if type(files) != str:
-            for i,row in files.iterrows():
-                pasteWithSubprocess(
-                    os.path.abspath(row['source']),
-                    os.path.abspath(f"{dpth}/{row['filename']}"))
+            # filename includes any timeShift applied to the source name
+            for source,filename in files[['source','filename']].values:
+                stageFile(
+                    os.path.abspath(source),
+                    os.path.abspath(f"{dpth}/{filename}"),
+                    self.staging)
         return(bin,toRun,dpth)
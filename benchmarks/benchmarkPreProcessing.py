@@ -0,0 +1,145 @@
+# Benchmark the pre-processing routines (searchRawDir, readFiles, mergeStats, groupAndFilter, filterData) against data size
+# Synthetic data are generated once per size (see syntheticData.py) and re-used for each number of processes
+# Each run uses a fresh metaDir, results are appended to a json lines file (one record per stage) for tracking over time
+# Example:
+#   python benchmarks/benchmarkPreProcessing.py --workDir C:/temp/benchmarks --nFiles 1000 10000 100000 --processes 1 4 8
+# Note: 100k files at 10 Hz and 30 minutes is ~150 GB of data, use a lower --frequency for quick comparisons
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,root)
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import syntheticData
+
+# Stages which are timed, nested stages (e.g., mergeStats is called by readFiles) are timed separately and included in their parent
+stages = ['searchRawDir','readFiles','mergeStats','userMetaDataUpdates','groupAndFilter','filterData']
+
+def gitCommit():
+    try:
+        return(subprocess.run(['git','rev-parse','--short','HEAD'],cwd=root,capture_output=True,text=True).stdout.strip())
+    except OSError:
+        return('')
+
+def timeStages(api,timings):
+    # Wrap the stage methods of an eddyProAPI instance to accumulate their run times
+    for stage in stages:
+        method = getattr(api,stage)
+        def timed(*args,method=method,stage=stage,**kwargs):
+            T1 = time.perf_counter()
+            try:
+                return(method(*args,**kwargs))
+            finally:
+                timings[stage] = timings.get(stage,0)+time.perf_counter()-T1
+        setattr(api,stage,timed)
+
+def runBenchmark(dataDir,workDir,nFiles,processes,args):
+    import eddyProAPI
+    siteID = f'BENCH_{nFiles}_{processes}'
+    shutil.rmtree(f'{workDir}/{siteID}',ignore_errors=True)
+    start = pd.Timestamp(args.start)
+    end = start+pd.Timedelta(minutes=args.duration*nFiles)
+    api = eddyProAPI.eddyProAPI(
+        runMode=0,
+        siteID=siteID,
+        sourceDir=[dataDir],
+        dateRange=[start.strftime('%Y-%m-%d %H:%M'),end.strftime('%Y-%m-%d %H:%M')],
+        fileType=args.fileType,
+        metaDataTemplate='Templates/CR1000_LI7500_Template.metadata' if args.fileType == 'TOA5' else 'None',
+        processes=processes,
+        lowMemory=args.lowMemory,
+        metaDataStorage=args.metaDataStorage,
+        rootDir={'Raw_HighFrequency_Data':workDir,'EddyPro':workDir,'Database':workDir}
+        )
+    timings = {}
+    timeStages(api,timings)
+    error = ''
+    T1 = time.perf_counter()
+    try:
+        api.preProcessing()
+    except (Exception,SystemExit) as e:
+        # eddyProAPI reports invalid inputs and missing data with sys.exit
+        error = repr(e)
+    total = time.perf_counter()-T1
+    return(timings,total,error)
+
+if __name__ == '__main__':
+    CLI = argparse.ArgumentParser(description='Benchmark the pre-processing routines on synthetic data')
+    CLI.add_argument('--workDir',required=True,help='Directory for the synthetic data and metadata (use a local disk)')
+    CLI.add_argument('--nFiles',type=int,nargs='+',default=[1000,10000,100000])
+    CLI.add_argument('--processes',type=int,nargs='+',default=[1,os.cpu_count()])
+    CLI.add_argument('--fileType',default='GHG',choices=['GHG','TOA5'])
+    CLI.add_argument('--start',default='2024-01-01')
+    CLI.add_argument('--frequency',type=float,default=10)
+    CLI.add_argument('--duration',type=int,default=30)
+    CLI.add_argument('--nColumns',type=int,default=len(syntheticData.ghgColumns))
+    CLI.add_argument('--configurations',type=int,default=2)
+    CLI.add_argument('--corrupt',type=float,default=0.001)
+    CLI.add_argument('--lowMemory',action=argparse.BooleanOptionalAction,default=True)
+    CLI.add_argument('--metaDataStorage',default='csv',choices=['csv','parquet'])
+    CLI.add_argument('--repeat',type=int,default=1)
+    CLI.add_argument('--results',default=None,help='json lines file for the results (default: workDir/preProcessingBenchmarks.jsonl)')
+    CLI.add_argument('--keepData',action=argparse.BooleanOptionalAction,default=True,help='Keep the synthetic data for later runs')
+    args = CLI.parse_args()
+    workDir = os.path.abspath(args.workDir)
+    results = args.results or f'{workDir}/preProcessingBenchmarks.jsonl'
+    os.makedirs(workDir,exist_ok=True)
+
+    environment = {
+        'commit':gitCommit(),
+        'host':socket.gethostname(),
+        'platform':platform.platform(),
+        'python':platform.python_version(),
+        'pandas':pd.__version__,
+        'numpy':np.__version__,
+        'cpu_count':os.cpu_count()
+        }
+    failed = 0
+    for nFiles in args.nFiles:
+        dataDir = f'{workDir}/synthetic_{args.fileType}_{nFiles}_{args.frequency}Hz_{args.duration}min_{args.nColumns}cols_{args.configurations}cfg'
+        if not os.path.isdir(dataDir):
+            print(f'Generating {nFiles} {args.fileType} files in {dataDir}')
+            T1 = time.perf_counter()
+            syntheticData.generate(dataDir,fileType=args.fileType,start=args.start,nFiles=nFiles,frequency=args.frequency,
+                                   duration=args.duration,nColumns=args.nColumns,configurations=args.configurations,
+                                   corrupt=args.corrupt)
+            print(f'Generated in {np.round(time.perf_counter()-T1,1)} seconds')
+        for processes in args.processes:
+            for repeat in range(args.repeat):
+                print(f'Benchmarking {nFiles} files on {processes} processes (repeat {repeat+1} of {args.repeat})')
+                timings,total,error = runBenchmark(dataDir,workDir,nFiles,processes,args)
+                print(pd.Series(timings|{'preProcessing':total}).round(3).to_string())
+                if error != '':
+                    # Stages after the failure were never timed, don't save a partial run
+                    print('Failed: ',error)
+                    failed += 1
+                    continue
+                record = {
+                    'benchmark':'preProcessing','date':datetime.now().isoformat(timespec='seconds'),
+                    'nFiles':nFiles,'processes':processes,'repeat':repeat,'fileType':args.fileType,
+                    'frequency':args.frequency,'duration':args.duration,'nColumns':args.nColumns,
+                    'configurations':args.configurations,'corrupt':args.corrupt,'lowMemory':args.lowMemory,
+                    'metaDataStorage':args.metaDataStorage
+                    } | environment
+                with open(results,'a') as f:
+                    for stage in stages+['preProcessing']:
+                        seconds = total if stage == 'preProcessing' else timings.get(stage)
+                        if seconds is not None:
+                            f.write(json.dumps(record|{'stage':stage,'seconds':np.round(seconds,4),
+                                                       'filesPerSecond':np.round(nFiles/seconds,2) if seconds > 0 else None})+'\n')
+        if args.keepData == False:
+            shutil.rmtree(dataDir)
+    print(f'Results saved to {results}')
+    if failed > 0:
+        sys.exit(f'{failed} benchmark run(s) failed, their timings were not saved')
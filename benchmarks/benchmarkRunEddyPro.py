@@ -0,0 +1,217 @@
+# Benchmark the orchestration of EddyPro runs (setupGroups, makeBatch, runEddyPro.setUp, runGroups, rpMerge, copyFinalOutputs)
+# EddyPro is replaced by fakeEddyPro.py, which spends a fixed time per file, so the overhead of the API can be measured on any OS
+# Overhead is reported as a fraction of the worker capacity (processes x wall time of runEP):
+#   configRendering: makeBatch (main process, all workers idle)
+#   planning: rest of setupGroups (main process)
+#   staging: runEddyPro.setUp, copying the EddyPro binaries and linking the raw files into hfData (workers)
+#   merge: rpMerge of the rp outputs for each group (workers)
+#   otherWorker: rest of rpRun/fccGroup, log copies and clean up (workers)
+#   schedulingIdle: worker time not spent on a task while runGroups is running
+#   publish: copyFinalOutputs and updateRuntimeHistory (main process)
+#   eddyPro: time spent in the (fake) EddyPro executables, everything else is overhead
+# Example:
+#   python benchmarks/benchmarkRunEddyPro.py --workDir /tmp/benchmarks --nFiles 480 --processes 1 4 8 --secondsPerFile 0.05
+# Requires a POSIX system, runEddyPro launches the .exe files through a .bat script on Windows
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,root)
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import syntheticData
+import fakeEddyPro
+import batchProcessing
+from benchmarkPreProcessing import gitCommit
+
+# Stages timed in the main process, makeBatch is nested in setupGroups
+mainStages = ['setupGroups','makeBatch','runGroups','copyFinalOutputs','updateRuntimeHistory']
+
+class timedRunEddyPro(batchProcessing.runEddyPro):
+    # runEddyPro which logs the duration of each step to timingsFile (one json line per step, from each worker process)
+    timingsFile = None
+
+    def timed(self,stage,method,*args):
+        T1 = time.perf_counter()
+        try:
+            return(method(*args))
+        finally:
+            with open(self.timingsFile,'a') as f:
+                f.write(json.dumps({'stage':stage,'seconds':time.perf_counter()-T1,'pid':os.getpid()})+'\n')
+
+    def rpRun(self,toRun):
+        return(self.timed('task',super().rpRun,toRun))
+
+    def fccGroup(self,toRun):
+        return(self.timed('task',super().fccGroup,toRun))
+
+    def setUp(self,toRun):
+        return(self.timed('staging',super().setUp,toRun))
+
+    def execute(self,bin,mode):
+        return(self.timed('eddyPro',super().execute,bin,mode))
+
+    def rpMerge(self,subsetName,ex_file,rpIntermediary):
+        return(self.timed('merge',super().rpMerge,subsetName,ex_file,rpIntermediary))
+
+def timeStages(api,timings,timingsFile):
+    # Wrap the stage methods of an eddyProAPI instance to accumulate their run times
+    for stage in mainStages:
+        method = getattr(api,stage)
+        def timed(*args,method=method,stage=stage,**kwargs):
+            T1 = time.perf_counter()
+            try:
+                return(method(*args,**kwargs))
+            finally:
+                timings[stage] = timings.get(stage,0)+time.perf_counter()-T1
+                if stage == 'setupGroups':
+                    # Swap in the timed runner before any batches are run
+                    api.runEddyPro.__class__ = timedRunEddyPro
+                    api.runEddyPro.timingsFile = timingsFile
+        setattr(api,stage,timed)
+
+def breakdown(timings,workerTimings,processes,total):
+    # Worker seconds by category, main process stages block all workers so they count once per process
+    worker = pd.DataFrame(workerTimings,columns=['stage','seconds','pid']).groupby('stage')['seconds'].sum() if len(workerTimings)>0 else pd.Series(dtype=float)
+    task,staging,eddyPro,merge = [float(worker.get(s,0)) for s in ['task','staging','eddyPro','merge']]
+    seconds = {
+        'configRendering':timings.get('makeBatch',0)*processes,
+        'planning':(timings.get('setupGroups',0)-timings.get('makeBatch',0))*processes,
+        'staging':staging,
+        'merge':merge,
+        'otherWorker':task-staging-eddyPro-merge,
+        'schedulingIdle':timings.get('runGroups',0)*processes-task,
+        'publish':(timings.get('copyFinalOutputs',0)+timings.get('updateRuntimeHistory',0))*processes,
+        'eddyPro':eddyPro,
+        }
+    capacity = total*processes
+    seconds['otherMain'] = capacity-sum(seconds.values())
+    fractions = {k:v/capacity if capacity > 0 else None for k,v in seconds.items()}
+    fractions['overhead'] = 1-fractions['eddyPro'] if capacity > 0 else None
+    return(seconds,fractions)
+
+def runBenchmark(dataDir,workDir,nFiles,processes,args):
+    import eddyProAPI
+    siteID = f'BENCH_EP_{nFiles}_{processes}'
+    shutil.rmtree(f'{workDir}/{siteID}',ignore_errors=True)
+    epRoot = f'{workDir}/fakeEddyPro'
+    fakeEddyPro.installFakeEddyPro(epRoot)
+    os.environ['FAKE_EDDYPRO_SECONDS_PER_FILE'] = str(args.secondsPerFile)
+    os.environ['FAKE_EDDYPRO_FCC_SECONDS_PER_ROW'] = str(args.secondsPerRow)
+    os.environ['FAKE_EDDYPRO_WORK'] = args.work
+    start = pd.Timestamp(args.start)
+    end = start+pd.Timedelta(minutes=args.duration*nFiles)
+    timingsFile = f'{workDir}/{siteID}_timings.jsonl'
+    if os.path.isfile(timingsFile):
+        os.remove(timingsFile)
+    timings = {}
+    error = ''
+    try:
+        # Pre-processing is run first and not timed
+        api = eddyProAPI.eddyProAPI(
+            runMode=1,
+            siteID=siteID,
+            sourceDir=[dataDir],
+            dateRange=[start.strftime('%Y-%m-%d %H:%M'),end.strftime('%Y-%m-%d %H:%M')],
+            fileType='GHG',
+            processes=processes,
+            priority='normal',
+            rpCache=False,
+            rootDir={'Raw_HighFrequency_Data':workDir,'EddyPro':epRoot,'Database':workDir}
+            )
+        timeStages(api,timings,timingsFile)
+        T1 = time.perf_counter()
+        api.runEP()
+        total = time.perf_counter()-T1
+    except (Exception,SystemExit) as e:
+        # eddyProAPI reports invalid inputs and missing data with sys.exit
+        error = repr(e)
+        if os.path.isfile(timingsFile):
+            os.remove(timingsFile)
+        return(timings,{},{},0,processes,0,0,error)
+    workerTimings = []
+    if os.path.isfile(timingsFile):
+        with open(timingsFile) as f:
+            workerTimings = [json.loads(line) for line in f]
+        os.remove(timingsFile)
+    status = getattr(api,'runStatus',{})
+    failed = sum(returncode != 0 for returncode,wallTime in status.values())
+    seconds,fractions = breakdown(timings,workerTimings,api.processes,total)
+    return(timings,seconds,fractions,total,api.processes,len(status),failed,error)
+
+if __name__ == '__main__':
+    CLI = argparse.ArgumentParser(description='Benchmark the orchestration of EddyPro runs with a fake EddyPro executable')
+    CLI.add_argument('--workDir',required=True,help='Directory for the synthetic data, metadata, and outputs (use a local disk)')
+    CLI.add_argument('--nFiles',type=int,nargs='+',default=[480])
+    CLI.add_argument('--processes',type=int,nargs='+',default=[1,os.cpu_count()])
+    CLI.add_argument('--start',default='2024-01-01')
+    CLI.add_argument('--frequency',type=float,default=1,help='Sampling frequency of the synthetic data (Hz), the fake EddyPro does not read the data')
+    CLI.add_argument('--duration',type=int,default=30)
+    CLI.add_argument('--configurations',type=int,default=2)
+    CLI.add_argument('--secondsPerFile',type=float,default=0.05,help='Time spent by the fake eddypro_rp per file')
+    CLI.add_argument('--secondsPerRow',type=float,default=0.001,help='Time spent by the fake eddypro_fcc per half-hour')
+    CLI.add_argument('--work',default='sleep',choices=['sleep','cpu'])
+    CLI.add_argument('--repeat',type=int,default=1)
+    CLI.add_argument('--results',default=None,help='json lines file for the results (default: workDir/runEddyProBenchmarks.jsonl)')
+    args = CLI.parse_args()
+    if sys.platform.startswith('win'):
+        sys.exit('The fake EddyPro executables are only supported on POSIX systems')
+    workDir = os.path.abspath(args.workDir)
+    results = args.results or f'{workDir}/runEddyProBenchmarks.jsonl'
+    os.makedirs(workDir,exist_ok=True)
+
+    environment = {
+        'commit':gitCommit(),
+        'host':socket.gethostname(),
+        'platform':platform.platform(),
+        'python':platform.python_version(),
+        'pandas':pd.__version__,
+        'numpy':np.__version__,
+        'cpu_count':os.cpu_count()
+        }
+    failed = 0
+    for nFiles in args.nFiles:
+        dataDir = f'{workDir}/synthetic_GHG_{nFiles}_{args.frequency}Hz_{args.duration}min_{len(syntheticData.ghgColumns)}cols_{args.configurations}cfg'
+        if not os.path.isdir(dataDir):
+            print(f'Generating {nFiles} GHG files in {dataDir}')
+            syntheticData.generate(dataDir,fileType='GHG',start=args.start,nFiles=nFiles,frequency=args.frequency,
+                                   duration=args.duration,configurations=args.configurations)
+        for processes in args.processes:
+            for repeat in range(args.repeat):
+                print(f'Benchmarking EddyPro runs for {nFiles} files on {processes} processes (repeat {repeat+1} of {args.repeat})')
+                timings,seconds,fractions,total,used,runs,failedRuns,error = runBenchmark(dataDir,workDir,nFiles,processes,args)
+                if error != '':
+                    # Stages after the failure were never timed, don't save a partial run
+                    print('Failed: ',error)
+                    failed += 1
+                    continue
+                record = {
+                    'benchmark':'runEddyPro','date':datetime.now().isoformat(timespec='seconds'),
+                    'nFiles':nFiles,'processes':processes,'processesUsed':used,'repeat':repeat,
+                    'configurations':args.configurations,'secondsPerFile':args.secondsPerFile,
+                    'secondsPerRow':args.secondsPerRow,'work':args.work,'runs':runs,'failed':failedRuns,
+                    'total':np.round(total,4)
+                    } | environment
+                with open(results,'a') as f:
+                    for stage in mainStages:
+                        if stage in timings:
+                            f.write(json.dumps(record|{'stage':stage,'seconds':np.round(timings[stage],4)})+'\n')
+                    for category in seconds.keys():
+                        f.write(json.dumps(record|{'stage':category,'workerSeconds':np.round(seconds[category],4),
+                                                   'fraction':np.round(fractions[category],4)})+'\n')
+                print(pd.DataFrame({'workerSeconds':seconds,'fraction':fractions}).round(3).to_string())
+                print(f"Orchestration overhead: {np.round(100*fractions['overhead'],1)}% of {np.round(total,2)} seconds x {used} processes")
+                if failedRuns > 0:
+                    print(f'{failedRuns} of {runs} EddyPro runs returned an error')
+    print(f'Results saved to {results}')
+    if failed > 0:
+        sys.exit(f'{failed} benchmark run(s) failed, their timings were not saved')
@@ -0,0 +1,116 @@
+# Benchmark sharded pre-processing (shardRole = worker/coordinator) on a single host
+# Launches nWorkers eddyProAPI.py worker processes and one coordinator, which share the metaDir the same way processes on several hosts would
+# Each process reads its shards with a pool of --processes, so nWorkers x processes should not exceed the cores available
+# Use --kill to terminate one worker part way through, its shard is taken over once the lease times out (see config.yml: sharding)
+# Example:
+#   python benchmarks/benchmarkShardedPreProcessing.py --workDir /tmp/benchmarks --nFiles 4464 --workers 1 2 4 --processes 2
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import signal
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+import syntheticData
+from benchmarkPreProcessing import gitCommit
+
+def command(role,siteID,shardRun,dataDir,workDir,start,end,processes,fileType):
+    rootDir = json.dumps({'Raw_HighFrequency_Data':workDir,'EddyPro':workDir,'Database':workDir})
+    return([sys.executable,f'{root}/eddyProAPI.py','--runMode','1','--shardRole',role,'--shardRun',shardRun,
+            '--siteID',siteID,'--sourceDir',dataDir,'--dateRange',start,end,'--fileType',fileType,
+            '--processes',str(processes),'--rootDir',rootDir])
+
+def runBenchmark(dataDir,workDir,nFiles,nWorkers,args):
+    siteID = f'BENCH_SHARD_{nFiles}_{nWorkers}'
+    shutil.rmtree(f'{workDir}/{siteID}',ignore_errors=True)
+    start = pd.Timestamp(args.start)
+    end = start+pd.Timedelta(minutes=args.duration*(nFiles-1))
+    dateRange = [start.strftime('%Y-%m-%d %H:%M'),end.strftime('%Y-%m-%d %H:%M')]
+    shardRun = datetime.now().strftime('%Y%m%dT%H%M%S')
+    logs = f'{workDir}/{siteID}_logs'
+    os.makedirs(logs,exist_ok=True)
+    T1 = time.perf_counter()
+    workers = []
+    for i in range(nWorkers):
+        with open(f'{logs}/worker_{i}.log','w') as log:
+            workers.append(subprocess.Popen(command('worker',siteID,shardRun,dataDir,workDir,*dateRange,args.processes,args.fileType),
+                                            stdout=log,stderr=subprocess.STDOUT,cwd=root))
+    if args.kill is not None and nWorkers>0:
+        time.sleep(args.kill)
+        workers[0].send_signal(signal.SIGKILL if hasattr(signal,'SIGKILL') else signal.SIGTERM)
+    with open(f'{logs}/coordinator.log','w') as log:
+        coordinator = subprocess.run(command('coordinator',siteID,shardRun,dataDir,workDir,*dateRange,args.processes,args.fileType),
+                                     stdout=log,stderr=subprocess.STDOUT,cwd=root)
+    total = time.perf_counter()-T1
+    for w in workers:
+        w.wait()
+    # Which process completed each shard
+    shardDir = f'{workDir}/{siteID}/metadata/shards/{shardRun}'
+    owners = {}
+    for label in sorted(os.listdir(shardDir)):
+        if os.path.isfile(f'{shardDir}/{label}/complete.json'):
+            with open(f'{shardDir}/{label}/complete.json') as f:
+                # Lease tokens are host_pid_id, a process takes a new lease for each shard
+                owners[label] = json.load(f)['owner'].rsplit('_',1)[0]
+    return(total,coordinator.returncode,owners,logs)
+
+if __name__ == '__main__':
+    CLI = argparse.ArgumentParser(description='Benchmark sharded pre-processing with several worker processes on one host')
+    CLI.add_argument('--workDir',required=True,help='Directory for the synthetic data and metadata (use a local disk)')
+    CLI.add_argument('--nFiles',type=int,nargs='+',default=[4464],help='Number of files, 1488 half-hourly files is ~1 month')
+    CLI.add_argument('--workers',type=int,nargs='+',default=[0,1,2,4],help='Number of worker processes besides the coordinator')
+    CLI.add_argument('--processes',type=int,default=2,help='Pool size of each worker and the coordinator')
+    CLI.add_argument('--fileType',default='GHG',choices=['GHG'])
+    CLI.add_argument('--start',default='2024-01-01')
+    CLI.add_argument('--frequency',type=float,default=1)
+    CLI.add_argument('--duration',type=int,default=30)
+    CLI.add_argument('--configurations',type=int,default=2)
+    CLI.add_argument('--kill',type=float,default=None,help='Kill the first worker after this many seconds')
+    CLI.add_argument('--results',default=None,help='json lines file for the results (default: workDir/shardedPreProcessingBenchmarks.jsonl)')
+    args = CLI.parse_args()
+    workDir = os.path.abspath(args.workDir)
+    results = args.results or f'{workDir}/shardedPreProcessingBenchmarks.jsonl'
+    os.makedirs(workDir,exist_ok=True)
+
+    environment = {
+        'commit':gitCommit(),
+        'host':socket.gethostname(),
+        'platform':platform.platform(),
+        'python':platform.python_version(),
+        'pandas':pd.__version__,
+        'numpy':np.__version__,
+        'cpu_count':os.cpu_count()
+        }
+    for nFiles in args.nFiles:
+        dataDir = f'{workDir}/synthetic_GHG_{nFiles}_{args.frequency}Hz_{args.duration}min_{len(syntheticData.ghgColumns)}cols_{args.configurations}cfg'
+        if not os.path.isdir(dataDir):
+            print(f'Generating {nFiles} GHG files in {dataDir}')
+            syntheticData.generate(dataDir,fileType='GHG',start=args.start,nFiles=nFiles,frequency=args.frequency,
+                                   duration=args.duration,configurations=args.configurations)
+        for nWorkers in args.workers:
+            print(f'Benchmarking {nFiles} files on {nWorkers} worker(s) + coordinator x {args.processes} processes')
+            total,returncode,owners,logs = runBenchmark(dataDir,workDir,nFiles,nWorkers,args)
+            record = {
+                'benchmark':'shardedPreProcessing','date':datetime.now().isoformat(timespec='seconds'),
+                'nFiles':nFiles,'workers':nWorkers,'processes':args.processes,'frequency':args.frequency,
+                'duration':args.duration,'configurations':args.configurations,'kill':args.kill,
+                'shards':len(owners),'owners':len(set(owners.values())),'returncode':returncode,
+                'seconds':np.round(total,4),'filesPerSecond':np.round(nFiles/total,2)
+                } | environment
+            with open(results,'a') as f:
+                f.write(json.dumps(record)+'\n')
+            print(pd.Series(owners,name='completed by').to_string())
+            print(f'{np.round(total,2)} seconds ({np.round(nFiles/total,1)} files per second)')
+            if returncode != 0:
+                print(f'Coordinator failed, see {logs}/coordinator.log')
+    print(f'Results saved to {results}')
@@ -0,0 +1,129 @@
+# Stand-in for the eddypro_rp and eddypro_fcc executables, for testing and benchmarking the run phase without EddyPro
+# Reads the project file, spends a configurable amount of time per file, and writes outputs shaped like those of EddyPro:
+#   rp: eddypro_{project_id}_fluxnet_*.csv, eddypro_{project_id}_biomet_*.csv, and binned cospectra for each staged file
+#   fcc: eddypro_{project_id}_full_output_*.csv for each row of the merged fluxnet file (ex_file)
+# Called as: fakeEddyPro.py rp|fcc [-s linux] [-e environment] [project file], matching the EddyPro command line
+# Cost per file is set with the environment variables:
+#   FAKE_EDDYPRO_SECONDS_PER_FILE (default 0.01), FAKE_EDDYPRO_FCC_SECONDS_PER_ROW (default 0.001)
+#   FAKE_EDDYPRO_WORK = sleep (default) or cpu, to busy-wait instead of sleeping
+#   FAKE_EDDYPRO_EXIT = exit status to return (default 0)
+# Use installFakeEddyPro to create an EddyPro "root" folder (bin/eddypro_rp, bin/eddypro_fcc) which calls this script
+
+import os
+import re
+import sys
+import time
+import stat
+import argparse
+import configparser
+import numpy as np
+from datetime import datetime,timedelta
+
+# File name timestamp formats (see config_files/ecFileFormats.yml)
+fileTimestamps = [
+    (re.compile(r'([0-9]{4}\-[0-9]{2}\-[0-9]{2}T[0-9]{6})'),'%Y-%m-%dT%H%M%S'),
+    (re.compile(r'([0-9]{4}\_[0-9]{2}\_[0-9]{2}\_[0-9]{4})'),'%Y_%m_%d_%H%M')
+    ]
+
+fluxnetColumns = ['TIMESTAMP_START','TIMESTAMP_END','FC','FC_SSITC_TEST','LE','LE_SSITC_TEST','H','H_SSITC_TEST','USTAR','WD','WS','TA','RH','PA']
+biometColumns = [('date','[yyyy-mm-dd]'),('time','[HH:MM]'),('TA_1_1_1','[K]'),('RH_1_1_1','[%]'),('PA_1_1_1','[Pa]'),('RG_1_1_1','[W+1m-2]')]
+fullOutputColumns = [('filename',''),('date','[yyyy-mm-dd]'),('time','[HH:MM]'),('DOY','[ddd.ddd]'),('daytime','[1=daytime]'),
+                     ('file_records','[#]'),('used_records','[#]'),('Tau','[kg+1m-1s-2]'),('qc_Tau','[#]'),('H','[W+1m-2]'),
+                     ('qc_H','[#]'),('LE','[W+1m-2]'),('qc_LE','[#]'),('co2_flux','[µmol+1s-1m-2]'),('qc_co2_flux','[#]')]
+
+def work(seconds):
+    if seconds <= 0:
+        return
+    if os.environ.get('FAKE_EDDYPRO_WORK','sleep') == 'cpu':
+        end = time.perf_counter()+seconds
+        x = 0
+        while time.perf_counter() < end:
+            x += 1
+    else:
+        time.sleep(seconds)
+
+def fileTimestamp(name):
+    for pattern,format in fileTimestamps:
+        match = pattern.search(name)
+        if match:
+            return(datetime.strptime(match.group(1),format))
+    return(None)
+
+def readProject(projectFile):
+    project = configparser.ConfigParser(interpolation=None)
+    project.read(projectFile)
+    return(project)
+
+def rp(project,runStamp,rng):
+    out_path = project['Project']['out_path']
+    project_id = project['Project']['project_id']
+    data_path = project['RawProcess_General']['data_path']
+    duration = float(project.get('RawProcess_Settings','avrg_len',fallback='30') or 30)
+    files = sorted(os.listdir(data_path)) if os.path.isdir(data_path) else []
+    timestamps = sorted(t for t in (fileTimestamp(f) for f in files) if t is not None)
+    os.makedirs(f'{out_path}/eddypro_binned_cospectra',exist_ok=True)
+    fluxnet,biomet = [],[]
+    for t in timestamps:
+        print(f' From: {t:%Y-%m-%d %H:%M} To: {t+timedelta(minutes=duration):%Y-%m-%d %H:%M}',flush=True)
+        work(float(os.environ.get('FAKE_EDDYPRO_SECONDS_PER_FILE',0.01)))
+        values = rng.normal(size=len(fluxnetColumns)-2).round(4)
+        fluxnet.append(','.join([f'{t:%Y%m%d%H%M}',f'{t+timedelta(minutes=duration):%Y%m%d%H%M}']+[str(v) for v in values]))
+        end = t+timedelta(minutes=duration)
+        biomet.append(','.join([f'{end:%Y-%m-%d}',f'{end:%H:%M}']+[str(v) for v in (rng.normal(size=len(biometColumns)-2)+[283,70,101325,200]).round(3)]))
+        with open(f'{out_path}/eddypro_binned_cospectra/{end:%Y%m%d-%H%M}_binned_cospectra_{runStamp}_adv.csv','w') as f:
+            f.write('natural_frequency,normalized_frequency,f_nat*cospec(w_ts)/cov(w_ts)\n')
+            f.write('\n'.join(f'{fr:.6f},{fr:.6f},{c:.6f}' for fr,c in zip(np.logspace(-4,1,50),rng.random(50)))+'\n')
+    with open(f'{out_path}/eddypro_{project_id}_fluxnet_{runStamp}_adv.csv','w') as f:
+        f.write(','.join(fluxnetColumns)+'\n'+''.join(row+'\n' for row in fluxnet))
+    with open(f'{out_path}/eddypro_{project_id}_biomet_{runStamp}_adv.csv','w') as f:
+        f.write(','.join(c for c,u in biometColumns)+'\n'+','.join(u for c,u in biometColumns)+'\n'+''.join(row+'\n' for row in biomet))
+    print(f' Raw data processing terminated. {len(timestamps)} files processed.',flush=True)
+
+def fcc(project,runStamp,rng):
+    out_path = project['Project']['out_path']
+    project_id = project['Project']['project_id']
+    ex_file = project['FluxCorrection_SpectralAnalysis_General']['ex_file']
+    rows = []
+    if os.path.isfile(ex_file):
+        with open(ex_file) as f:
+            rows = [line.split(',') for line in f.read().splitlines()[1:] if line.strip() != '']
+    secondsPerRow = float(os.environ.get('FAKE_EDDYPRO_FCC_SECONDS_PER_ROW',0.001))
+    with open(f'{out_path}/eddypro_{project_id}_full_output_{runStamp}_adv.csv','w') as f:
+        f.write('file_info,,,,,,,corrected_fluxes_and_quality_flags\n')
+        f.write(','.join(c for c,u in fullOutputColumns)+'\n')
+        f.write(','.join(u for c,u in fullOutputColumns)+'\n')
+        for row in rows:
+            work(secondsPerRow)
+            end = datetime.strptime(row[1],'%Y%m%d%H%M')
+            values = rng.normal(size=len(fullOutputColumns)-7).round(4)
+            f.write(','.join([f'{end:%Y-%m-%dT%H%M%S}_fake.ghg',f'{end:%Y-%m-%d}',f'{end:%H:%M}',f'{end.timetuple().tm_yday:.3f}','1','18000','18000']+[str(v) for v in values])+'\n')
+    print(f' Flux computation and correction terminated. {len(rows)} records processed.',flush=True)
+
+def installFakeEddyPro(epRoot,python=sys.executable):
+    # Create epRoot/bin/eddypro_rp and eddypro_fcc launchers for this script, returns the bin folder
+    bin = os.path.abspath(f'{epRoot}/bin')
+    os.makedirs(bin,exist_ok=True)
+    for mode in ['rp','fcc']:
+        fn = f'{bin}/eddypro_{mode}'
+        with open(fn,'w') as f:
+            f.write(f'#!/bin/sh\nexec "{python}" "{os.path.abspath(__file__)}" {mode} "$@"\n')
+        os.chmod(fn,os.stat(fn).st_mode|stat.S_IXUSR|stat.S_IXGRP|stat.S_IXOTH)
+    return(bin)
+
+if __name__ == '__main__':
+    CLI = argparse.ArgumentParser(description='Stand-in for eddypro_rp/eddypro_fcc')
+    CLI.add_argument('mode',choices=['rp','fcc'])
+    CLI.add_argument('-s',dest='system',default='linux')
+    CLI.add_argument('-e',dest='environment',default=os.path.dirname(os.getcwd()))
+    CLI.add_argument('projectFile',nargs='?',default=None)
+    args = CLI.parse_intermixed_args()
+    projectFile = args.projectFile or f'{args.environment}/ini/processing.eddypro'
+    project = readProject(projectFile)
+    runStamp = datetime.now().strftime('%Y-%m-%dT%H%M%S')
+    rng = np.random.default_rng(abs(hash(project['Project']['project_id']))%2**32)
+    print(f' Running fake eddypro_{args.mode} for {project["Project"]["project_id"]}',flush=True)
+    if args.mode == 'rp':
+        rp(project,runStamp,rng)
+    else:
+        fcc(project,runStamp,rng)
+    sys.exit(int(os.environ.get('FAKE_EDDYPRO_EXIT',0)))
@@ -0,0 +1,203 @@
+# Generate synthetic high frequency EC data for testing and benchmarking the pre-processing routines
+# .ghg: LI-COR style zip archives (.metadata + tab separated .data) in raw/YYYY/MM/ subfolders
+# .dat: Campbell Scientific TOA5 files matching a template .metadata file (e.g., Templates/CR1000_LI7500_Template.metadata)
+# Supports configurable sampling frequency, file duration, column count, configuration changes, and corrupt files
+# Example, one week of 10 Hz .ghg files with a change in instrument height halfway through:
+#   python benchmarks/syntheticData.py --outDir C:/temp/synthetic --start 2024-01-01 --nFiles 336 --configurations 2
+
+import os
+import zipfile
+import argparse
+import configparser
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+# Columns of an LI-7200 + sonic .ghg file: (header name, variable, instrument, unit)
+ghgColumns = [
+    ('Seconds','ignore','',''),
+    ('Nanoseconds','ignore','',''),
+    ('Date','not_numeric','',''),
+    ('Time','not_numeric','',''),
+    ('DIAG','ignore','',''),
+    ('U (m/s)','u','sonic','m_sec'),
+    ('V (m/s)','v','sonic','m_sec'),
+    ('W (m/s)','w','sonic','m_sec'),
+    ('T (C)','ts','sonic','celsius'),
+    ('CO2 (mmol/m^3)','co2','irga','mmol_m3'),
+    ('H2O (mmol/m^3)','h2o','irga','mmol_m3'),
+    ('Cell Temperature (C)','cell_t','irga','celsius'),
+    ('Total Pressure (kPa)','int_p','irga','kpa'),
+    ('Flow Rate (lpm)','flowrate','irga','lpm'),
+    ]
+
+# Mean and standard deviation of the synthetic signal by variable
+signals = {
+    'u':(2,1.5),'v':(0,1.5),'w':(0,0.3),'ts':(10,0.5),
+    'co2':(16,0.2),'h2o':(500,20),'cell_t':(12,0.1),'int_p':(98,0.05),'flowrate':(15,0.1)
+    }
+
+# Root of the repository, default templates are relative to it
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def timestamps(start,nFiles,duration):
+    return(pd.date_range(start,periods=nFiles,freq=f'{duration}min'))
+
+def configuration(i,nFiles,configurations):
+    # Index of the site configuration of file i, configurations change at evenly spaced intervals
+    return(int(i*configurations/nFiles))
+
+def signal(rng,variable,n):
+    mean,sd = signals.get(variable,(0,1))
+    return(rng.normal(mean,sd,n))
+
+def ghgMetadata(siteID,frequency,duration,columns,config):
+    # LI-COR style .metadata, the instrument height changes with each configuration
+    md = {
+        'Project':{'title':siteID,'id':siteID,'file_name':'','sw_version':'8.8.32'},
+        'Files':{'data_path':'','tstamp_end':'0'},
+        'Site':{'site_name':siteID,'site_id':siteID,'altitude':'10','latitude':'49.1','longitude':'-122.9',
+                'canopy_height':'0.5','displacement_height':'0.33','roughness_length':'0.05'},
+        'Station':{'station_name':siteID,'station_id':siteID},
+        'Timing':{'acquisition_frequency':str(frequency),'file_duration':str(duration),'pc_time_settings':'utc'},
+        'Instruments':{
+            'instr_1_manufacturer':'csi','instr_1_model':'csat3_1','instr_1_id':'sonic','instr_1_height':f'{2+0.5*config:.2f}',
+            'instr_1_wformat':'uvw','instr_1_wref':'axis','instr_1_north_offset':'0',
+            'instr_2_manufacturer':'licor','instr_2_model':'li7200_1','instr_2_id':'irga','instr_2_sw_version':'8.8.32',
+            'instr_2_tube_length':'71.1','instr_2_tube_diameter':'5.33','instr_2_tube_flowrate':'15',
+            'instr_2_northward_separation':'-11','instr_2_eastward_separation':'-10','instr_2_vertical_separation':'0',
+            },
+        'FileDescription':{'separator':'tab','header_rows':'8','data_label':'DATA'}
+        }
+    for i,(header,variable,instrument,unit) in enumerate(columns):
+        md['FileDescription'] |= {f'col_{i+1}_variable':variable,f'col_{i+1}_instrument':instrument,
+                                  f'col_{i+1}_measure_type':'molar_density' if variable in ['co2','h2o'] else '',
+                                  f'col_{i+1}_unit_in':unit}
+    text = ';GHG_METADATA\n'
+    for section,options in md.items():
+        text += f'[{section}]\n'+''.join(f'{k}={v}\n' for k,v in options.items())+'\n'
+    return(text)
+
+def ghgData(rng,timestamp,frequency,duration,columns):
+    n = int(frequency*60*duration)
+    t = timestamp+pd.to_timedelta(np.arange(n)/frequency,unit='s')
+    data = {}
+    for header,variable,instrument,unit in columns:
+        if header == 'Seconds':
+            data[header] = (t.asi8//10**9).astype(str)
+        elif header == 'Nanoseconds':
+            data[header] = (t.asi8%10**9).astype(str)
+        elif header == 'Date':
+            data[header] = t.strftime('%Y-%m-%d')
+        elif header == 'Time':
+            data[header] = t.strftime('%H:%M:%S:%f').str[:-3]
+        elif header == 'DIAG':
+            data[header] = np.full(n,'8191')
+        else:
+            x = signal(rng,variable,n)
+            # Occasional gaps in the data
+            x[rng.random(n)<0.001] = np.nan
+            data[header] = x
+    df = pd.DataFrame(data)
+    df.insert(0,'DATAH','DATA')
+    text = (f'Model:\tLI-7200 Enclosed CO2/H2O Analyzer\nSN:\t72H-0000\nInstrument:\tirga\nFile Type:\t2\n'
+            f'Software Version:\t8.8.32\nTimestamp:\t{timestamp:%H:%M:%S}\nTimezone:\tUTC\n')
+    return(text+df.to_csv(sep='\t',index=False,float_format='%.4f',na_rep='NaN'))
+
+def ghgFile(args):
+    # Write one .ghg file, args: (outDir,siteID,timestamp,frequency,duration,nColumns,config,corrupt,seed)
+    outDir,siteID,timestamp,frequency,duration,nColumns,config,corrupt,seed = args
+    rng = np.random.default_rng(seed)
+    columns = ghgColumns+[(f'Aux {i+1}',f'aux_{i+1}','','') for i in range(max(0,nColumns-len(ghgColumns)))]
+    base = f"{timestamp:%Y-%m-%dT%H%M%S}_{siteID}"
+    folder = f"{outDir}/{timestamp:%Y}/{timestamp:%m}"
+    os.makedirs(folder,exist_ok=True)
+    fn = f"{folder}/{base}.ghg"
+    if corrupt == 'truncated':
+        # Not a valid zip archive
+        with open(fn,'wb') as f:
+            f.write(b'PK\x03\x04'+rng.bytes(512))
+        return(fn)
+    with zipfile.ZipFile(fn,'w',zipfile.ZIP_DEFLATED) as ghg:
+        ghg.writestr(f'{base}.metadata',ghgMetadata(siteID,frequency,duration,columns,config))
+        if corrupt != 'missingData':
+            ghg.writestr(f'{base}.data',ghgData(rng,timestamp,frequency,duration,columns))
+    return(fn)
+
+def toa5File(args):
+    # Write one TOA5 .dat file, args: (outDir,siteID,timestamp,frequency,duration,template,config,corrupt,seed)
+    # The columns follow the FileDescription of the template, numeric columns are offset by the configuration
+    outDir,siteID,timestamp,frequency,duration,template,config,corrupt,seed = args
+    rng = np.random.default_rng(seed)
+    md = configparser.ConfigParser()
+    md.read(template)
+    variables = []
+    i = 1
+    while md.has_option('FileDescription',f'col_{i}_variable'):
+        variables.append(md['FileDescription'][f'col_{i}_variable'])
+        i += 1
+    n = int(frequency*60*duration)
+    t = timestamp+pd.to_timedelta(np.arange(n)/frequency,unit='s')
+    data,names = {},[]
+    for i,variable in enumerate(variables):
+        name = 'TIMESTAMP' if variable == 'not_numeric' else ('RECORD' if variable == 'ignore' and i < 2 else f'{variable}_{i+1}')
+        names.append(name)
+        if variable == 'not_numeric':
+            data[name] = t.strftime('"%Y-%m-%d %H:%M:%S.%f').str[:-5]+'"'
+        elif variable == 'ignore':
+            data[name] = np.arange(n)
+        else:
+            data[name] = signal(rng,variable,n)+0.1*config
+    df = pd.DataFrame(data)
+    fn = f"{outDir}/TOA5_{siteID}.ts_data_{timestamp:%Y_%m_%d_%H%M}.dat"
+    os.makedirs(outDir,exist_ok=True)
+    with open(fn,'w') as f:
+        f.write(f'"TOA5","{siteID}","CR1000","1234","CR1000.Std.32","CPU:{siteID}.CR1","1234","ts_data"\n')
+        f.write(','.join(f'"{c}"' for c in names)+'\n')
+        f.write(','.join('"TS"' if c == 'TIMESTAMP' else '"RN"' if c == 'RECORD' else '""' for c in names)+'\n')
+        f.write(','.join('""' if c in ['TIMESTAMP','RECORD'] else '"Smp"' for c in names)+'\n')
+        if corrupt == 'truncated':
+            f.write(df.iloc[:n//10].to_csv(header=False,index=False,float_format='%.4f',quoting=3)[:-7])
+        elif corrupt != 'missingData':
+            f.write(df.to_csv(header=False,index=False,float_format='%.4f',quoting=3,na_rep='NAN'))
+    return(fn)
+
+def generate(outDir,fileType='GHG',start='2024-01-01',nFiles=48,frequency=10,duration=30,nColumns=14,
+             configurations=1,corrupt=0.0,siteID='SYNTH',template=f'{root}/Templates/CR1000_LI7500_Template.metadata',
+             processes=os.cpu_count(),seed=0):
+    # Write nFiles synthetic files to outDir, returns the list of files
+    # corrupt is the fraction of files which are corrupt (alternating between truncated files and archives without data)
+    rng = np.random.default_rng(seed)
+    corruptFiles = set(rng.choice(nFiles,int(nFiles*corrupt),replace=False))
+    corruptType = {i:['truncated','missingData'][j%2] for j,i in enumerate(sorted(corruptFiles))}
+    tasks = []
+    for i,timestamp in enumerate(timestamps(start,nFiles,duration)):
+        config = configuration(i,nFiles,configurations)
+        if fileType == 'GHG':
+            tasks.append((outDir,siteID,timestamp,frequency,duration,nColumns,config,corruptType.get(i),seed+i))
+        else:
+            tasks.append((outDir,siteID,timestamp,frequency,duration,template,config,corruptType.get(i),seed+i))
+    function = ghgFile if fileType == 'GHG' else toa5File
+    if processes > 1:
+        with Pool(processes=processes) as pool:
+            return(pool.map(function,tasks,chunksize=max(1,len(tasks)//(processes*4))))
+    return([function(t) for t in tasks])
+
+if __name__ == '__main__':
+    CLI = argparse.ArgumentParser(description='Generate synthetic high frequency EC data files')
+    CLI.add_argument('--outDir',required=True)
+    CLI.add_argument('--fileType',default='GHG',choices=['GHG','TOA5'])
+    CLI.add_argument('--start',default='2024-01-01')
+    CLI.add_argument('--nFiles',type=int,default=48)
+    CLI.add_argument('--frequency',type=float,default=10,help='Sampling frequency (Hz)')
+    CLI.add_argument('--duration',type=int,default=30,help='File duration (minutes)')
+    CLI.add_argument('--nColumns',type=int,default=len(ghgColumns),help='Number of columns in .ghg files (extra columns are auxiliary variables)')
+    CLI.add_argument('--configurations',type=int,default=1,help='Number of distinct site configurations')
+    CLI.add_argument('--corrupt',type=float,default=0.0,help='Fraction of corrupt files')
+    CLI.add_argument('--siteID',default='SYNTH')
+    CLI.add_argument('--template',default=f'{root}/Templates/CR1000_LI7500_Template.metadata',help='.metadata template for TOA5 files')
+    CLI.add_argument('--processes',type=int,default=os.cpu_count())
+    CLI.add_argument('--seed',type=int,default=0)
+    args = CLI.parse_args()
+    files = generate(**vars(args))
+    print(f'Wrote {len(files)} files to {os.path.abspath(args.outDir)}')
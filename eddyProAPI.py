@@ -7,9 +7,12 @@ import sys
 import yaml
 import time
 import json
+import hashlib
 import shutil
 import fnmatch
 import argparse
+import queue
+import threading
 from glob import glob
 import batchProcessing
 import pyDbTools.readBinary as readBinary
@@ -18,11 +21,10 @@ import numpy as np
 import pandas as pd
 import configparser
 from pathlib import Path
-from functools import partial
 from collections import Counter, defaultdict
 from multiprocessing import Pool
 from datetime import datetime,date
-from HelperFunctions import progressbar,dumpToBiometDatabase
+from HelperFunctions import progressbar,dumpToBiometDatabase,readMetadataTable,writeMetadataTable,compileFilter,stageTracer
 importlib.reload(batchProcessing)
 
 # Default arguments
@@ -50,10 +52,83 @@ defaultArgs = {
     'biometUser':False,
     'metaDataUpdates':'None',
     'lowMemory':True,
-    'sampleFile':'None'
+    'sampleFile':'None',
+    'metaDataStorage':'csv',
+    'exportCSV':False,
+    'rpCache':True,
+    'plan':False,
+    'rootDir':{},
+    'shardRole':'None',
+    'shardRun':'None',
+    'trace':False,
+    'profile':[],
+    'profileMemory':[]
     }
 
+def batchLabel(i):
+    # Batch labels: A-Z, AA, AB, ...
+    label = ''
+    while i > 0:
+        i,r = divmod(i-1,26)
+        label = chr(ord('A')+r)+label
+    return(label)
+
+def simulateRuns(tasks,processes):
+    # Predicted wall time of the runs in tasks = {group: ([rp batch durations], fcc duration)} on a pool of processes
+    # Follows the dispatch order of runGroups: longest rp batches first, fcc runs as soon as all rp batches of a group are done
+    workers = [0.0]*processes
+    pending = sorted([(-d,g) for g,(rp,fcc) in tasks.items() for d in rp])
+    remaining = {g:len(rp) for g,(rp,fcc) in tasks.items()}
+    groupDone = {g:0.0 for g in tasks.keys()}
+    ready = []
+    end = 0.0
+    while len(pending)>0 or len(ready)>0:
+        i = int(np.argmin(workers))
+        if len(ready)>0 and min(r[0] for r in ready) <= workers[i]:
+            start,g = min(ready)
+            ready.remove((start,g))
+            workers[i] = max(workers[i],start)+tasks[g][1]
+        elif len(pending)>0:
+            d,g = pending.pop(0)
+            workers[i] += -d
+            remaining[g] -= 1
+            groupDone[g] = max(groupDone[g],workers[i])
+            if remaining[g] == 0:
+                ready.append((groupDone[g],g))
+        else:
+            start,g = min(ready)
+            ready.remove((start,g))
+            workers[i] = max(workers[i],start)+tasks[g][1]
+        end = max(end,workers[i])
+    return(end)
+
+def calendarBatches(timestamps,freq,minSize):
+    # Batch number (1, 2, ...) of each of the (sorted) timestamps of a group, one batch per calendar period (freq)
+    # so a batch keeps the same window and files (and rpCache entry) as new data are added to the group
+    # Calendar periods (Y, Q, M, W, D) follow the calendar, sub-daily periods (e.g., 6h) are aligned to midnight
+    # Consecutive periods are combined until they have at least minSize files (a short last batch is combined with the previous)
+    if freq.endswith('h'):
+        codes = pd.factorize(timestamps.floor(freq),sort=True)[0]
+    else:
+        codes = pd.factorize(timestamps.to_period(freq),sort=True)[0]
+    counts = np.bincount(codes)
+    batchOfPeriod = np.zeros(counts.shape[0],dtype=np.int32)
+    size = counts[0]
+    for i in range(1,counts.shape[0]):
+        if size >= minSize:
+            batchOfPeriod[i] = batchOfPeriod[i-1]+1
+            size = counts[i]
+        else:
+            batchOfPeriod[i] = batchOfPeriod[i-1]
+            size += counts[i]
+    if size < minSize and batchOfPeriod[-1] > 0:
+        batchOfPeriod[batchOfPeriod == batchOfPeriod[-1]] -= 1
+    return(batchOfPeriod[codes]+1)
+
 class eddyProAPI():
+    # Tables written by searchRawDir and readFiles, which are split by shard in sharded pre-processing
+    shardTables = ['fileInventory','rawDataStatistics','metaDataValues']
+
     def __init__(self,**kwargs):
         # Directory of current script
         abspath = os.path.abspath(__file__)
@@ -77,10 +152,14 @@ class eddyProAPI():
         self.setup()
         self.runMode = int(self.runMode)
         if self.runMode > 0:
-            if self.runMode <= 2:
-                self.preProcessing()
-            if self.runMode >= 2:
-                self.runEP()
+            try:
+                with self.tracer.span('run','run',siteID=self.siteID,runMode=self.runMode,processes=self.processes):
+                    if self.runMode <= 2:
+                        self.preProcessing()
+                    if self.runMode >= 2 and self.shardRole != 'worker':
+                        self.runEP()
+            finally:
+                self.tracer.save()
 
     def setup(self):
         # Task common between the two modules
@@ -116,8 +195,10 @@ class eddyProAPI():
         if os.path.isfile('config_files/user_path_definitions.yml'):
             with open('config_files/user_path_definitions.yml') as yml:
                 self.config.update(yaml.safe_load(yml))
-        else:
+        elif self.rootDir == {}:
             sys.exit(f"Missing {'config_files/user_path_definitions.yml'}")
+        # rootDir paths given as an argument take precedence over user_path_definitions.yml
+        self.config['rootDir'] = self.config.get('rootDir',{}) | self.rootDir
 
         # Setup paths using definitions from config file
         self.config['Paths'] = {}
@@ -129,14 +210,29 @@ class eddyProAPI():
         if self.sourceDir == []:
             self.sourceDir = self.config['Paths']['sourceDir']
 
-        for key in self.config['metadataFiles'].keys():
-            self.config[key] = os.path.abspath(self.config['Paths']['metaDir']+'/'+key+'.csv')
-            self.config['metadataFiles'][key]['filepath_or_buffer'] = self.config[key]
+        self.metadataPaths(self.config['Paths']['metaDir'])
+        # Persistent index of the raw files in sourceDir, allows searchRawDir to skip unchanged directories
+        self.config['rawFileIndex'] = os.path.abspath(self.config['Paths']['metaDir']+'/rawFileIndex.json')
+        # Persistent registry of configuration groups, keeps groupIDs stable between runs
+        self.config['groupRegistry'] = os.path.abspath(self.config['Paths']['metaDir']+'/groupRegistry.json')
+        # Sharded pre-processing: processes on one or more hosts sharing the metaDir split the dateRange into month shards (see processShards)
+        # shardRole = worker or coordinator, all processes of a run are given the same shardRun ID and dateRange
+        if self.shardRole != 'None':
+            if self.shardRole not in ['worker','coordinator'] or self.shardRun == 'None':
+                sys.exit('Sharded pre-processing requires shardRole (worker or coordinator) and a shardRun ID shared by all processes of the run')
+            self.config['shardDir'] = os.path.abspath(self.config['Paths']['metaDir']+'/shards/'+self.shardRun)
+        # Seconds per file of previous EddyPro runs by settings and group, used to plan the rp batches
+        self.config['runtimeHistory'] = os.path.abspath(self.config['Paths']['metaDir']+'/runtimeHistory.json')
         # Read the existing metadata from a previous run if they exist
         if self.reset == True: self.resetInventory()
         # Create the directories if they doesn't exist
         os.makedirs(self.config['Paths']['metaDir'],exist_ok=True)
         os.makedirs(self.config['Paths']['outputDir'],exist_ok=True)
+        # Stage tracing (trace = True) and profiling (stages listed in profile/profileMemory), see HelperFunctions.stageTracer
+        # Worker processes append their spans to the same directory (traceDir = None when tracing is off)
+        traceDir = os.path.abspath(self.config['Paths']['metaDir']+'/trace/'+datetime.now().strftime('%Y%m%dT%H%M%S'))
+        self.tracer = stageTracer(traceDir,self.trace,self.profile,self.profileMemory)
+        self.config['traceDir'] = traceDir if self.trace == True else None
         # On the fly Biomet and dynamicMetadata csv file generation
         # For Biomet.net users only
         if self.biometUser and os.path.isdir(self.config['rootDir']['Database']):
@@ -160,23 +256,51 @@ class eddyProAPI():
                     self.eddyProGroupDefsTemplate['RawProcess_BiometMeasurements'][key] = list(self.biometDataTable.columns).index(value)+1
         
         # Read the existing metadata from a previous run if they exist
-        read_files = {key:value for key,value in self.config['metadataFiles'].items() if value['filepath_or_buffer'].startswith('f"')==False}
+        # Column headers of the tables on file, used to check if new rows can be appended
+        self.savedColumns = {}
+        self.loadMetadataFiles()
+
+        if self.sampleFile != 'None':
+            self.sampleFile = pd.read_csv(self.sampleFile,**self.config[self.fileType]['fileDescription'])
+            self.makeMetaDataTemplate()
+
+    def metadataPaths(self,metaDir):
+        # Point the metadata tables to metaDir (the metaDir, or the directory of a shard)
+        self.config['metadataTables'] = {}
+        for key in self.config['metadataFiles'].keys():
+            self.config[key] = os.path.abspath(metaDir+'/'+key+'.csv')
+            self.config['metadataFiles'][key]['filepath_or_buffer'] = self.config[key]
+            # Path to the month-partitioned parquet version of the table (when metaDataStorage = parquet)
+            self.config['metadataTables'][key] = os.path.abspath(metaDir+'/'+key)
+
+    def loadMetadataFiles(self,keys=None):
+        if keys is None:
+            keys = self.config['metadataFiles'].keys()
+        read_files = {key:value for key,value in self.config['metadataFiles'].items() if key in keys and value['filepath_or_buffer'].startswith('f"')==False}
         dtypes = defaultdict(lambda:'object',groupID='int')
         for category, dtype in {'groupBy':'string','track':'float','pass':'string'}.items():
             for key,value in self.config['monitoringInstructions']['metaData'][category].items():
                 for val in value:
                     dtypes[(key,val)]=dtype
         for key,value in read_files.items():
-            if os.path.isfile(value['filepath_or_buffer']):
+            if self.metaDataStorage == 'parquet':
+                # Tables with a TIMESTAMP index are partitioned by month, only load months overlapping the dateRange
+                partition = 'parse_dates' in value
+                exists = os.path.isdir(self.config['metadataTables'][key]) or os.path.isfile(self.config['metadataTables'][key]+'.parquet')
+                if os.path.isfile(value['filepath_or_buffer']) and not exists:
+                    print(f"Migrating {value['filepath_or_buffer']} to parquet")
+                    writeMetadataTable(pd.read_csv(dtype=dtypes,**value),self.config['metadataTables'][key],partition)
+                setattr(self,key,readMetadataTable(self.config['metadataTables'][key],self.dateRange if partition else None,partition))
+            elif os.path.isfile(value['filepath_or_buffer']):
                 print(value['filepath_or_buffer'])
                 setattr(self, key,(pd.read_csv(dtype=dtypes,**value)))
+                if 'parse_dates' in value:
+                    # The default object dtype keeps the parsed timestamps in an object index
+                    getattr(self,key).index = pd.DatetimeIndex(getattr(self,key).index)
+                self.savedColumns[key] = getattr(self,key).columns
             else:
                 setattr(self, key,pd.DataFrame())            
 
-        if self.sampleFile != 'None':
-            self.sampleFile = pd.read_csv(self.sampleFile,**self.config[self.fileType]['fileDescription'])
-            self.makeMetaDataTemplate()
-
     def makeMetaDataTemplate(self):
         metaData = configparser.ConfigParser()
         template = os.path.dirname(os.path.realpath(__file__))+'/Templates/InstrumentDefualts/'
@@ -251,12 +375,28 @@ class eddyProAPI():
 
     def preProcessing(self):
         mainTime = time.time()
-        self.searchRawDir()
-        self.readFiles()
+        if self.shardRole == 'None':
+            with self.tracer.span('searchRawDir'):
+                self.searchRawDir()
+            with self.tracer.span('readFiles'):
+                self.readFiles()
+        else:
+            with self.tracer.span('processShards'):
+                self.processShards()
+            if self.shardRole == 'worker':
+                print(f"Shards complete, time elapsed {np.round(time.time()-mainTime,3)} seconds")
+                return
+            with self.tracer.span('mergeShards'):
+                self.mergeShards()
         if self.metaDataUpdates != 'None':
             print('Applying Manual Metadata Adjustments')
-            self.userMetaDataUpdates() 
-        self.groupAndFilter()
+            with self.tracer.span('userMetaDataUpdates'):
+                self.userMetaDataUpdates() 
+        with self.tracer.span('groupAndFilter'):
+            self.groupAndFilter()
+        if self.metaDataStorage == 'parquet' and self.exportCSV == True:
+            with self.tracer.span('exportMetadataFiles'):
+                self.exportMetadataFiles()
         print(f"Pre-Processing complete, time elapsed {np.round(time.time()-mainTime,3)} seconds")
         
     def searchRawDir(self):
@@ -271,68 +411,77 @@ class eddyProAPI():
         elif os.path.isdir(self.sourceDir):
             search_dirs.append(self.sourceDir)
         T1 = time.time()
-        # Walk the search directories
+        # Quit if none of the source directories exist, a shard without data is complete
+        if len(search_dirs) == 0:
+            if self.shardRole != 'None':
+                print('No Data Found')
+                return
+            sys.exit('No Data Found')
+        if self.fileType == 'auto':
+            # Use the first directory containing files to determine the filetype
+            fileList = []
+            for search in search_dirs:
+                for dir, _, fileList in os.walk(search):
+                    if len(fileList)>0:break
+                if len(fileList)>0:break
+            if len(fileList) == 0:
+                if self.shardRole != 'None':
+                    print('No Data Found')
+                    return
+                sys.exit('No Data Found')
+            fileTypes = [f.split('.')[-1] for f in fileList]
+            self.fileType = max(set(fileTypes), key=fileTypes.count)
+            if self.fileType == 'dat':
+                testFile = [f for f in fileList if f.endswith(self.fileType)]
+                testFile = testFile[max(0,len(testFile)-2)]
+                with open(f"{dir}/{testFile}",'r') as f:
+                    if 'TOA5' in f.readline():
+                        self.fileType = 'TOA5'
+            print(f'Auto-determined filetype: {self.fileType}')
+        if self.fileType.lower() != 'ghg' and self.metaDataTemplate == 'None':
+            # Parser = batchProcessing.Parser(self.config,self.metaDataTemplate,debug=self.debug)
+            # df = (Parser.readData(dir+'/'+[f for f in fileList if f.endswith(self.fileType)][0]))
+            sys.exit('Give valid metadata file')
+        fileInfo = self.config[self.fileType.upper()]
+        fileInfo['searchTag'] = self.searchTag
+        fileInfo['excludeTag'] = self.genericID
+        fileInfo['timeShift'] = self.timeShift
+        # Walk the search directories, only new or modified files need to be parsed
+        fileIndex = batchProcessing.rawFileIndex(self.config['rawFileIndex'],fileInfo)
         for search in search_dirs:
-            for dir, _, fileList in os.walk(search):
-                # Exclude files that have already been processed from fileList
-                if 'source' in self.fileInventory.columns:
-                    print(self.fileInventory.index)
-                    source_list = self.fileInventory.loc[((self.fileInventory.index>=self.dateRange.min())&
-                                                          (self.fileInventory.index<=self.dateRange.max())),'source'].values
-                    source_names = [os.path.basename(f) for f in source_list]
-                else:
-                    source_names = []
-                fileList = [f for f in fileList if f not in source_names]
-                if self.fileType == 'auto':
-                    fileTypes = [f.split('.')[-1] for f in fileList]
-                    self.fileType = max(set(fileTypes), key=fileTypes.count)
-                    if self.fileType == 'dat':
-                        testFile = [f for f in fileList if f.endswith(self.fileType)]
-                        testFile = testFile[max(0,len(testFile)-2)]
-                        with open(testFile,'r') as f:
-                            if 'TOA5' in f.readline():
-                                self.fileType = 'TOA5'
-                    print(f'Auto-determined filetype: {self.fileType}')
-                if self.fileType.lower() != 'ghg' and self.metaDataTemplate == 'None':
-                    # Parser = batchProcessing.Parser(self.config,self.metaDataTemplate,debug=self.debug)
-                    # df = (Parser.readData(dir+'/'+[f for f in fileList if f.endswith(self.fileType)][0]))
-                    sys.exit('Give valid metadata file')
-                fileInfo = self.config[self.fileType.upper()]
-                fileInfo['searchTag'] = self.searchTag
-                fileInfo['excludeTag'] = self.genericID
-                fileInfo['timeShift'] = self.timeShift
-                if len(fileList)>0:
-                    print(f'Searching {dir}')
-                    dout = []
-                    if (__name__ == 'eddyProAPI' or __name__ == '__main__') and self.processes>1:
-                        # run routine in parallel
-                        pb = progressbar(len(fileList),'')
-                        with Pool(processes=self.processes) as pool:
-                            max_chunksize=10
-                            chunksize=min(int(np.ceil(len(fileList)/self.processes)),max_chunksize)
-                            for out in pool.imap(partial(batchProcessing.findFiles,in_dir=dir,fileInfo=fileInfo,dateRange=self.dateRange),fileList,chunksize=chunksize):
-                                pb.step()
-                                dout.append(out)
-                            pool.close()
-                            pb.close()
-                    else:
-                        # run routine sequentially for debugging
-                        for i,filename in enumerate(fileList):
-                            out = batchProcessing.findFiles(filename,dir,fileInfo=fileInfo,dateRange=self.dateRange)
-                            dout.append(out)
-                    # Dump results to inventory
-                    # source and filename will be different if a timeShift is applied when copying
-                    df = pd.DataFrame(columns=['TIMESTAMP','source','filename','file_prototype'],data=dout)
-                    # Add empty columns for auxillary information
-                    df[['Filter Flags']]=self.config['stringTags']['NaN']
-                    df['TIMESTAMP'] = pd.DatetimeIndex(df['TIMESTAMP'])
-                    df = df.set_index('TIMESTAMP')
-                    # drop rows where filename_final are missing
-                    df = df.loc[df['filename'].isnull()==False]
-                    # Merge with existing inventory   
-                    self.fileInventory = pd.concat([self.fileInventory,df])
-        # Quit if no data were found
+            fileIndex.scan(search)
+        for dir,fileList in list(fileIndex.toParse.items()):
+            print(f'Searching {dir}')
+            if self.debug == False:
+                # parse the full directory listing in one vectorized pass
+                dout = batchProcessing.findFilesBatch(fileList,dir,fileInfo).values.tolist()
+            else:
+                # run routine file by file for debugging
+                dout = []
+                for i,filename in enumerate(fileList):
+                    out = batchProcessing.findFiles(filename,dir,fileInfo=fileInfo)
+                    dout.append(out)
+            fileIndex.update(dir,fileList,dout)
+        fileIndex.save()
+        # Dump results to inventory
+        # source and filename will be different if a timeShift is applied when copying
+        df = fileIndex.inventory()
+        df = df.loc[(df['TIMESTAMP']>=self.dateRange.min())&(df['TIMESTAMP']<=self.dateRange.max())]
+        # Exclude files that have already been processed
+        if 'source' in self.fileInventory.columns:
+            source_names = set(os.path.basename(f) for f in self.fileInventory['source'].values if type(f) == str)
+            df = df.loc[df['source'].apply(os.path.basename).isin(source_names)==False]
+        if df.shape[0]>0:
+            # Add empty columns for auxillary information
+            df[['Filter Flags']]=self.config['stringTags']['NaN']
+            df = df.set_index('TIMESTAMP')
+            # Merge with existing inventory
+            self.fileInventory = pd.concat([self.fileInventory,df])
+        # Quit if no data were found, a shard without data is complete
         if self.fileInventory.empty:
+            if self.shardRole != 'None':
+                print('No Data Found')
+                return
             sys.exit('No Data Found')
         # Resample to get timestamp on consistent half-hourly intervals
         self.fileInventory = self.fileInventory.resample('30min').first()
@@ -344,7 +493,7 @@ class eddyProAPI():
         if 'groupID' in self.fileInventory.columns:
             self.fileInventory['groupID'] = self.fileInventory['groupID'].replace({self.config['stringTags']['NaN']:self.config['intNaN']})
             self.fileInventory['groupID'] = self.fileInventory['groupID'].astype(int)
-        self.fileInventory.to_csv(self.config['fileInventory'])
+        self.saveMetadataFiles(['fileInventory'])
         print('Files Search Complete, time elapsed: ',np.round(time.time()-T1,3))
         
     def readFiles(self):
@@ -352,82 +501,247 @@ class eddyProAPI():
         print('Reading Data for:')
         # Parse down to just files that need to be processed (those which have not already been assigned a group or set to exclude)
         to_process = self.fileInventory.loc[(
-            (self.fileInventory['source'].str.endswith(self.fileType))&
+            (self.fileInventory['source'].str.endswith(self.config[self.fileType.upper()]['extension']))&
             (self.fileInventory.index.isin(self.metaDataValues.index)==False)&
             (self.fileInventory.index>=self.dateRange.min())&(self.fileInventory.index<=self.dateRange.max())
             ),'source'].copy()
         # Call file handler to parse files in parallel (default) or sequentially for troubleshooting
         byMonth = to_process.resample('MS').count()
-
-        for m,v in byMonth.items():
+        parallel = (__name__ == 'eddyProAPI' or __name__ == '__main__') and self.processes>1 and byMonth.sum()>0
+        if parallel:
+            # One pool for the whole run, the initializer builds a Parser once in each worker process
+            pool = Pool(processes=self.processes,
+                        initializer=batchProcessing.initParser,
+                        initargs=(self.config,self.metaDataTemplate,self.debug,self.lowMemory,self.config['traceDir']),
+                        maxtasksperchild=self.config['readFiles']['maxtasksperchild'])
+            # Set on an error to release the task handler if it is waiting for room in the window (see boundedTasks)
+            stop = threading.Event()
+        else:
             # Initiate parser class, defined externally to facilitate parallel processing
-            Parser = batchProcessing.Parser(self.config,self.metaDataTemplate,debug=self.debug)
-            T2 = time.time()
-            if v >0:
-                print(f"{m.year}-{m.month}")
-                self.mergeStats(out=Parser.nOut)
-                pathList = to_process.loc[((to_process.index.year == m.year)&(to_process.index.month == m.month))]
-                if (__name__ == 'eddyProAPI' or __name__ == '__main__') and self.processes>1:
-                    # run routine in parallel
-                    pb = progressbar(len(pathList),'')
-                    with Pool(processes=self.processes,maxtasksperchild=100) as pool:
-                        max_chunksize=10
-                        chunksize=min(int(np.ceil(len(pathList)/self.processes)),max_chunksize)
-                        for out in pool.imap(partial(Parser.readFile),pathList.items(),chunksize=chunksize):
-                            pb.step()
-                            self.mergeStats(out)
-                        pool.close()
-                        pb.close()
-                else:
-                    # run routine sequentially
-                    for i, (timestamp,file) in enumerate(pathList.items()):
-                        T2 = time.time()
-                        out = Parser.readFile((timestamp,file))
-                        self.mergeStats(out)
-                        if self.debug == True:
-                            print(f'{file} complete, time elapsed:git ',np.round(time.time()-T2,3)) 
-            self.mergeStats()
-            print(f"{m.year}-{m.month} complete in : ",np.round(time.time()-T2,3))
+            Parser = batchProcessing.Parser(self.config,self.metaDataTemplate,debug=self.debug,lowMemory=self.lowMemory)
+        try:
+            for m,v in byMonth.items():
+                T2 = time.time()
+                if v >0:
+                    with self.tracer.span(f"{m.year}-{m.month:02d}",'month',files=int(v)):
+                        print(f"{m.year}-{m.month}")
+                        self.mergeStats(out=batchProcessing.Parser.nOut)
+                        pathList = to_process.loc[((to_process.index.year == m.year)&(to_process.index.month == m.month))]
+                        if parallel:
+                            # run routine in parallel, results are merged in the order they complete
+                            # limit the number of files in flight so the main process never buffers more than a few results per worker
+                            pb = progressbar(len(pathList),'')
+                            window = threading.BoundedSemaphore(self.processes*self.config['readFiles']['tasksPerProcess'])
+                            for out in pool.imap_unordered(batchProcessing.readFileWorker,batchProcessing.boundedTasks(pathList.items(),window,stop)):
+                                window.release()
+                                pb.step()
+                                self.mergeStats(out)
+                            pb.close()
+                        else:
+                            # run routine sequentially
+                            for i, (timestamp,file) in enumerate(pathList.items()):
+                                T3 = time.time()
+                                with self.tracer.span(os.path.basename(file),'file'):
+                                    out = Parser.readFile((timestamp,file))
+                                self.mergeStats(out)
+                                if self.debug == True:
+                                    print(f'{file} complete, time elapsed: ',np.round(time.time()-T3,3))
+                        # Month boundaries are checkpoints, results are saved but the pool is kept
+                        with self.tracer.span('mergeStats','stage'):
+                            self.mergeStats()
+                        print(f"{m.year}-{m.month} complete in : ",np.round(time.time()-T2,3))
+        except BaseException:
+            # Including KeyboardInterrupt, outstanding tasks are discarded
+            if parallel:
+                stop.set()
+                pool.terminate()
+                pool.join()
+            raise
+        if parallel:
+            pool.close()
+            pool.join()
         print('Reading Complete, total time elapsed: ',np.round(time.time()-T1,3))
 
     def mergeStats(self,out=None):
+        # Results are accumulated in lists and concatenated once per flush (out=None)
+        # Only the new rows are persisted, see appendMetadataFile
         T1 = time.time()
         if out is None:
-            for key,df in self.tempStats.items():
-                if key == 1: 
-                    self.rawDataStatistics = pd.concat([self.rawDataStatistics,df])
-                elif key == 2:self.metaDataValues = pd.concat([self.metaDataValues,df])
-                self.rawDataStatistics.to_csv(self.config['rawDataStatistics'])
-                self.metaDataValues.to_csv(self.config['metaDataValues'])
+            for key,results in self.tempStats.items():
+                if len(results) == 0:
+                    continue
+                df = pd.concat(results).sort_index()
+                table = {1:'rawDataStatistics',2:'metaDataValues'}[key]
+                setattr(self,table,pd.concat([getattr(self,table),df]))
+                self.appendMetadataFile(table,df)
+            self.tempStats = {key:[] for key in self.tempStats.keys()}
         elif type(out) == type(1):
             self.tempStats = {}
             for i in range(out):
-                self.tempStats[i+1] = pd.DataFrame()
+                self.tempStats[i+1] = []
+            self.filledColumns = {}
         elif out[1] is not None:
             for i,o in enumerate(out):
                 if i > 0:
-                    # Fill any "missing" column levels
-                    cols = o.columns
-                    nuCols = []
-                    for c in cols:
-                        c = [a if a != '' else self.config['stringTags']['NaN'] for a in c]
-                        nuCols.append(tuple(c))
-                    o.columns = pd.MultiIndex.from_tuples(nuCols)
-                    self.tempStats[i] = pd.concat([self.tempStats[i],o])
+                    # Fill any "missing" column levels, files with the same columns reuse the filled header
+                    cols = tuple(o.columns)
+                    if cols not in self.filledColumns:
+                        nuCols = []
+                        for c in cols:
+                            c = [a if a != '' else self.config['stringTags']['NaN'] for a in c]
+                            nuCols.append(tuple(c))
+                        self.filledColumns[cols] = pd.MultiIndex.from_tuples(nuCols)
+                    o.columns = self.filledColumns[cols]
+                    self.tempStats[i].append(o)
             if self.debug == True:
                 print(out[0],np.round(time.time()-T1,2))
+
+    def appendMetadataFile(self,key,new):
+        # Persist the rows added by mergeStats without rewriting the rest of the table
+        # parquet: only the partitions for the months in new are rewritten
+        # csv: rows are appended if the header on file is unchanged, otherwise the table is rewritten
+        df = getattr(self,key)
+        if self.metaDataStorage == 'parquet':
+            writeMetadataTable(df,self.config['metadataTables'][key],months=new.index.to_period('M').unique())
+        elif key in self.savedColumns and self.savedColumns[key].equals(df.columns) and os.path.isfile(self.config[key]):
+            new.reindex(columns=df.columns).to_csv(self.config[key],mode='a',header=False)
+        else:
+            df.to_csv(self.config[key])
+        self.savedColumns[key] = df.columns
     
+    def shardManifest(self):
+        # Month shards of the dateRange {label:[start,end]}, saved to the shardDir by the first process of the run
+        # The other processes check they were given the same dateRange
+        months = pd.date_range(self.dateRange.min().to_period('M').to_timestamp(),self.dateRange.max(),freq='MS')
+        shards = {}
+        for m in months:
+            start = max(m,self.dateRange.min())
+            end = min(m+pd.offsets.MonthBegin(1)-pd.Timedelta(1,'ns'),self.dateRange.max())
+            shards[m.strftime('%Y-%m')] = [str(start),str(end)]
+        manifest = {'siteID':self.siteID,'dateRange':[str(self.dateRange.min()),str(self.dateRange.max())],'shards':shards}
+        os.makedirs(self.config['shardDir'],exist_ok=True)
+        fn = self.config['shardDir']+'/run.json'
+        if batchProcessing.createExclusive(fn,json.dumps(manifest)) == False:
+            with open(fn) as f:
+                stored = json.load(f)
+            if stored['siteID'] != manifest['siteID'] or stored['dateRange'] != manifest['dateRange']:
+                sys.exit(f"shardRun {self.shardRun} was started for {stored['siteID']} {stored['dateRange']}, use a new shardRun ID")
+            shards = stored['shards']
+        return({label:pd.DatetimeIndex(bounds) for label,bounds in shards.items()})
+
+    def processShards(self):
+        # Claim and process shards (searchRawDir and readFiles for one month) until every shard of the run is complete
+        # Shards are claimed with a lease file (see batchProcessing.shardLease), a shard whose holder stops sending heartbeats is taken over
+        # Each attempt writes to its own directory, complete.json points the coordinator to the attempt which completed the shard
+        shards = self.shardManifest()
+        settings = self.config['sharding']
+        dateRange = self.dateRange
+        tables = {key:getattr(self,key) for key in self.shardTables}
+        done = lambda label: os.path.isfile(f"{self.config['shardDir']}/{label}/complete.json")
+        try:
+            while True:
+                pending = [label for label in shards.keys() if done(label) == False]
+                if len(pending) == 0:
+                    break
+                claimed = False
+                for label in pending:
+                    lease = batchProcessing.shardLease(f"{self.config['shardDir']}/{label}.lease",settings['heartbeat'],settings['leaseTimeout'])
+                    if lease.acquire():
+                        claimed = True
+                        try:
+                            # Another process may have completed the shard between the listing and the claim
+                            if done(label) == False:
+                                self.processShard(label,shards[label],tables,lease)
+                        finally:
+                            lease.release()
+                        break
+                if claimed == False:
+                    print(f'Waiting on {len(pending)} shard(s) held by other processes')
+                    time.sleep(settings['poll'])
+        finally:
+            self.dateRange = dateRange
+            self.metadataPaths(self.config['Paths']['metaDir'])
+            for key,df in tables.items():
+                setattr(self,key,df)
+            self.savedColumns = {}
+
+    def processShard(self,label,dateRange,tables,lease):
+        T1 = time.time()
+        print(f'Processing shard {label}')
+        attempt = f"{self.config['shardDir']}/{label}/{lease.token}"
+        os.makedirs(attempt,exist_ok=True)
+        self.metadataPaths(attempt)
+        self.dateRange = dateRange
+        # Start from the rows of the metaDir tables in the shard, so only new files are read (same as an unsharded run)
+        for key,df in tables.items():
+            if df.empty == False:
+                df = df.loc[(df.index>=dateRange.min())&(df.index<=dateRange.max())].copy()
+            setattr(self,key,df)
+        self.savedColumns = {}
+        with self.tracer.span(label,'shard'):
+            self.searchRawDir()
+            if self.fileInventory.empty == False:
+                self.readFiles()
+            self.saveMetadataFiles([key for key in self.shardTables if getattr(self,key).empty == False])
+        info = {'attempt':attempt,'owner':lease.token,'seconds':np.round(time.time()-T1,3)}
+        if lease.complete(f"{self.config['shardDir']}/{label}/complete.json",info):
+            print(f'Shard {label} complete, time elapsed: ',np.round(time.time()-T1,3))
+        else:
+            print(f'Lost the lease on shard {label}, results discarded')
+
+    def mergeShards(self):
+        # Merge the tables of the completed shards into the metaDir tables, rows from the shards take precedence
+        T1 = time.time()
+        print('Merging shards')
+        with open(self.config['shardDir']+'/run.json') as f:
+            shards = json.load(f)['shards']
+        parts = {key:[getattr(self,key)] for key in self.shardTables}
+        try:
+            for label in shards.keys():
+                with open(f"{self.config['shardDir']}/{label}/complete.json") as f:
+                    attempt = json.load(f)['attempt']
+                self.metadataPaths(attempt)
+                self.loadMetadataFiles(self.shardTables)
+                for key in self.shardTables:
+                    parts[key].append(getattr(self,key))
+        finally:
+            self.metadataPaths(self.config['Paths']['metaDir'])
+        for key,dfs in parts.items():
+            dfs = [df for df in dfs if df.empty == False]
+            df = pd.concat(dfs) if len(dfs)>0 else pd.DataFrame()
+            if df.empty == False:
+                df = df.loc[~df.index.duplicated(keep='last')].sort_index()
+            setattr(self,key,df)
+        if self.fileInventory.empty:
+            sys.exit('No Data Found')
+        self.savedColumns = {}
+        self.saveMetadataFiles(self.shardTables)
+        print('Shards merged, time elapsed: ',np.round(time.time()-T1,3))
+
     def userMetaDataUpdates(self):
         df = pd.read_csv(self.metaDataUpdates,header=[0,1])
         df[('TIMESTAMP','Start')] = pd.to_datetime(df[('TIMESTAMP','Start')])
         df[('TIMESTAMP','End')] = pd.to_datetime(df[('TIMESTAMP','End')])
         df[('TIMESTAMP','End')] = df[('TIMESTAMP','End')].fillna(self.metaDataValues.index.max())
-        for i,row in df.iterrows():
-            for col in row.index:
-                if col[0] !=  'TIMESTAMP' and pd.isnull(row[col])==False:
-                    self.metaDataValues.loc[((self.metaDataValues.index>=row[('TIMESTAMP','Start')]) &
-                                            (self.metaDataValues.index<=row[('TIMESTAMP','End')])),col] = str(row[col])
-            
+        # Convert each update to an interval of positions on the (sorted) timestamp index
+        order = np.argsort(self.metaDataValues.index.values,kind='stable')
+        timestamps = self.metaDataValues.index.values[order]
+        start = np.searchsorted(timestamps,df[('TIMESTAMP','Start')].values,side='left')
+        end = np.searchsorted(timestamps,df[('TIMESTAMP','End')].values,side='right')
+        # Apply the intervals column by column in the order they are listed, so later rows take precedence
+        for col in df.columns:
+            if col[0] == 'TIMESTAMP' or df[col].isnull().all():
+                continue
+            if col in self.metaDataValues.columns:
+                values = self.metaDataValues[col].values.astype(object)[order]
+            else:
+                values = np.full(self.metaDataValues.shape[0],np.nan,dtype=object)
+            for i in np.where(df[col].notnull().values)[0]:
+                values[start[i]:end[i]] = str(df[col].iloc[i])
+            updated = np.empty_like(values)
+            updated[order] = values
+            self.metaDataValues[col] = updated
+
     def groupAndFilter(self):
         print('Grouping by Configuration')
         # As defined in monitoringInstructions, group timestamps by site configurations to define eddyPro Runs
@@ -450,8 +764,13 @@ class eddyProAPI():
         self.metaDataValues[grouper+passer] = self.metaDataValues[grouper+passer].replace('',self.config['stringTags']['NaN'])
         # Generate group labels based off unique configurations of groupBy values
         self.groupID = ('group','ID')
+        # IDs are looked up in the groupRegistry by hash of the groupBy values, so existing groups keep their IDs
+        configurations,inverse = np.unique(self.metaDataValues[grouper].astype(str).to_numpy(dtype=str),axis=0,return_inverse=True)
+        registry = batchProcessing.groupRegistry(self.config['groupRegistry'],self.config['stringTags']['NaN'])
+        groupIDs = registry.assign(grouper,configurations)
+        registry.save()
         groupLabels = pd.DataFrame(columns=pd.MultiIndex.from_tuples([self.groupID]),
-                             data=(self.metaDataValues.groupby(by=grouper).grouper.group_info[0] + 1),
+                             data=groupIDs[inverse.reshape(-1)],
                              index = self.metaDataValues.index)
         if self.groupID in self.metaDataValues.columns:
             self.metaDataValues = self.metaDataValues.drop(columns=self.groupID)    
@@ -560,11 +879,17 @@ class eddyProAPI():
 
     def filterData(self):
         print("Applying Filters:")
-        # Alias to simplify eval statement definitions
-        
+        # Filters are compiled once (see HelperFunctions.compileFilter) and each statistic is tested in one pass over all groups
+        # Flags are tracked as a boolean matrix (timestamps x labels) and converted to "Filter Flags" strings once at the end
+        NaN = self.config['stringTags']['NaN']
         Data = self.rawDataStatistics.loc[
             (self.rawDataStatistics.index>=self.dateRange.min())&(self.rawDataStatistics.index<=self.dateRange.max())].astype('float')
-        self.fileInventory['Filter Flags'] = self.config['stringTags']['NaN']
+        dataGroups = Data.loc[:,pd.IndexSlice[['group'],['ID']]].max(axis=1).values
+        # Position of each row of Data in the fileInventory
+        inventoryIX = self.fileInventory.index.get_indexer(Data.index)
+        inventoryGroups = self.fileInventory['groupID'].values
+        labels = []
+        flags = []
         for name,rule in self.config['monitoringInstructions']['dataFilters'].items():
             print(name,':')
             nfilt = 0
@@ -579,38 +904,80 @@ class eddyProAPI():
                 header_names = col.apply(lambda lst: [
                     'col_'+k+'_header_name' for k,c in zip(Counter(lst).keys(),Counter(lst).values())
                     if c == max(Counter(lst).values())])
-                # For every unique configuration, apply the filtering rule
-                for (groupID,groupRow),headers in zip(self.configurationGroups.iterrows(),header_names):
-                    # Get column names corresponding to query
-                    h = groupRow.loc[pd.IndexSlice[['Custom'],headers,['first']]].values
-                    # Get rows corresponding to groups
-                    groupIX = (Data.loc[:,pd.IndexSlice[['group'],['ID']]]==groupID).max(axis=1).values
-                    for stat,filter in parameters['filters'].items():
-                        variables = pd.IndexSlice[h,:,[stat]]
-                        if self.config['stringTags']['NaN'] not in h:
-                            test = eval(filter).max(axis=1)
-                            flag = test[test==True].index
-                            nfilt+=flag.shape[0]
-                            # Add a filter flag to exclude timestamps from EddyPro runs and list the corresponding exclusion condition
-                            self.fileInventory.loc[flag.values,'Filter Flags'] = (self.fileInventory.loc[flag.values,'Filter Flags'].str.replace(self.config['stringTags']['NaN'],'')+f',{name}: {condition}').str.lstrip(',')
-                        else:
-                            self.fileInventory.loc[self.fileInventory['groupID']==groupID,'Filter Flags'] = (self.fileInventory.loc[self.fileInventory['groupID']==groupID,'Filter Flags'].str.replace(self.config['stringTags']['NaN'],'')+f',{name}: Data not available').str.lstrip(',')
+                # Get column names corresponding to query for every unique configuration
+                groupHeaders = {groupID:groupRow.loc[pd.IndexSlice[['Custom'],headers,['first']]].values
+                                for (groupID,groupRow),headers in zip(self.configurationGroups.iterrows(),header_names)}
+                flagged = np.zeros(self.fileInventory.shape[0],dtype=bool)
+                missing = np.zeros(self.fileInventory.shape[0],dtype=bool)
+                for stat,filter in parameters['filters'].items():
+                    test = compileFilter(filter)
+                    # Stack the relevant statistics for every group into one array, padded with NaN where groups have fewer columns
+                    columns = {groupID:[i for i,c in enumerate(Data.columns) if c[0] in h and c[2] == stat]
+                               for groupID,h in groupHeaders.items() if NaN not in h}
+                    nCols = max([len(c) for c in columns.values()]+[1])
+                    values = np.full((Data.shape[0],nCols),np.nan)
+                    valid = np.zeros((Data.shape[0],nCols),dtype=bool)
+                    for groupID,h in groupHeaders.items():
+                        if NaN in h:
+                            missing |= inventoryGroups == groupID
+                        elif len(columns[groupID])>0:
+                            rows = np.where(dataGroups == groupID)[0]
+                            values[np.ix_(rows,range(len(columns[groupID])))] = Data.iloc[rows,columns[groupID]].values
+                            valid[np.ix_(rows,range(len(columns[groupID])))] = True
+                    with np.errstate(invalid='ignore'):
+                        result = (np.broadcast_to(test(values),values.shape)&valid).any(axis=1)
+                    nfilt += result.sum()
+                    # Add a filter flag to exclude timestamps from EddyPro runs and list the corresponding exclusion condition
+                    flagged[inventoryIX[result&(inventoryIX>=0)]] = True
+                labels.append(f'{name}: {condition}')
+                flags.append(flagged)
+                if missing.any():
+                    labels.append(f'{name}: Data not available')
+                    flags.append(missing)
                 print(nfilt)
-        self.fileInventory.loc[self.fileInventory['Filter Flags'] != self.config['stringTags']['NaN'],'groupID'] = self.config['intNaN']
+        # Label each timestamp once per unique combination of flags
+        self.fileInventory['Filter Flags'] = NaN
+        if len(flags)>0:
+            flags = np.column_stack(flags)
+            unique,inverse = np.unique(flags,axis=0,return_inverse=True)
+            flagLabels = [','.join(l for l,f in zip(labels,row) if f) for row in unique]
+            flagLabels = np.array([l if l != '' else NaN for l in flagLabels],dtype=object)
+            self.fileInventory['Filter Flags'] = flagLabels[inverse.reshape(-1)]
+        self.fileInventory.loc[self.fileInventory['Filter Flags'] != NaN,'groupID'] = self.config['intNaN']
 
-    def saveMetadataFiles(self):
+    def saveMetadataFiles(self,keys=None):
         # Save the revised inventory
-        self.fileInventory.to_csv(self.config['fileInventory'])
-        self.rawDataStatistics.to_csv(self.config['rawDataStatistics'])
-        self.metaDataValues.to_csv(self.config['metaDataValues'])
-        self.configurationGroups.to_csv(self.config['configurationGroups'])
+        if keys is None:
+            keys = self.config['metadataFiles'].keys()
+        for key in keys:
+            if self.metaDataStorage == 'parquet':
+                writeMetadataTable(getattr(self,key),self.config['metadataTables'][key],'parse_dates' in self.config['metadataFiles'][key])
+            else:
+                getattr(self,key).to_csv(self.config[key])
+            self.savedColumns[key] = getattr(self,key).columns
+
+    def exportMetadataFiles(self):
+        # Dump the full (all partitions) parquet tables to the csv files for viewing by hand
+        for key,value in self.config['metadataFiles'].items():
+            partition = 'parse_dates' in value
+            df = readMetadataTable(self.config['metadataTables'][key],None,partition)
+            print(f'Exporting {self.config[key]}')
+            df.to_csv(self.config[key])
         
     def runEP(self):
         mainTime = time.time()
-        self.setupGroups()
-        self.runGroups()
+        with self.tracer.span('setupGroups'):
+            self.setupGroups()
+        if self.plan == True:
+            # Dry run, print the batches and predicted run time without running EddyPro
+            self.printPlan()
+            return
+        with self.tracer.span('runGroups',batches=len(self.rpBatches)+len(self.fccList)):
+            self.runGroups()
+        self.updateRuntimeHistory()
         if self.debug == False:
-            self.copyFinalOutputs()
+            with self.tracer.span('copyFinalOutputs'):
+                self.copyFinalOutputs()
         print(f"runEP complete, time elapsed {np.round(time.time()-mainTime,3)} seconds")
 
     def setupGroups(self):
@@ -628,33 +995,55 @@ class eddyProAPI():
         self.rpBatches = {}
         self.fccList = []
         self.ex_fileList = []    
+        # Tasks of each group: rp batches -> merge -> fcc
+        self.groupTasks = {}
+        # Compiled .eddypro settings and file inventory of each group, see makeBatch
+        self.batchTemplates = {}
+        self.groupInventory = {}
         self.groupIDValues = [f"group_{id}" for id in self.configurationGroups.index]
+        # Re-use the outputs of rp batches which are unchanged since a previous run
+        cache = None
+        if self.rpCache == True:
+            cache = batchProcessing.rpCache(self.config['Paths']['metaDir']+'/rpCache',self.config['rpCache']['maxSize'])
         self.runEddyPro = batchProcessing.runEddyPro(self.config['Paths']['baseEddyPro'],
-                        self.groupIDValues,self.priority,self.debug)
-        for groupID,groupInfo in self.configurationGroups.iterrows():
-            groupTimeStamps = self.fileInventory.loc[self.fileInventory['groupID']==groupID].index
-            groupTimeStamps = groupTimeStamps[((groupTimeStamps>=self.dateRange.min())&
-                                               (groupTimeStamps<=self.dateRange.max()))]
-            ix = pd.Series([i for i in range(groupTimeStamps.shape[0])])
-            if ix.shape[0]>0:
-                self.batchesPerGroup(ix.shape[0],groupID)
-                bins = np.arange(0,self.nBatchesPerGroup+1)/self.nBatchesPerGroup
-                labels = np.arange(1,self.nBatchesPerGroup+1).astype(np.int32)
-                batches = pd.qcut(ix,q=bins,labels=labels)
-                for id in batches.unique():
-                    self.makeBatch(groupID,f"group_{groupID}_rp_{chr(ord('@')+id)}",
-                                groupInfo,
-                                groupTimeStamps[batches==id].min(),
-                                groupTimeStamps[batches==id].max()+pd.Timedelta(minutes=int(groupInfo['Timing','file_duration','first'])),
-                                groupTimeStamps[batches==id].shape[0])
-                self.makeBatch(groupID,f"group_{groupID}_fcc",
-                                groupInfo,
-                                groupTimeStamps.min(),
-                                groupTimeStamps.max()+pd.Timedelta(minutes=int(groupInfo['Timing','file_duration','first'])),
-                                groupTimeStamps.shape[0])
+                        self.groupIDValues,self.priority,self.debug,cache,self.config['stagingMode'],self.config['cpuAffinity'],
+                        self.config['traceDir'])
+        groupTimeStamps = {}
+        for groupID in self.configurationGroups.index:
+            timestamps = self.fileInventory.loc[self.fileInventory['groupID']==groupID].index
+            timestamps = timestamps[((timestamps>=self.dateRange.min())&(timestamps<=self.dateRange.max()))]
+            if timestamps.shape[0]>0:
+                groupTimeStamps[groupID] = timestamps.sort_values()
+        # Predicted run time (seconds) of each batch, used to dispatch the longest batches first
+        self.batchCost = {}
+        plannedTasks = {}
+        groupBatches = self.planBatches(groupTimeStamps)
+        for groupID,timestamps in groupTimeStamps.items():
+            groupInfo = self.configurationGroups.loc[groupID]
+            batches = groupBatches[groupID]
+            cost = self.runtimeCost(groupID)
+            plannedTasks[groupID] = ([],cost['fcc']*timestamps.shape[0]+self.config['costModel']['batchOverhead'])
+            for id in np.unique(batches):
+                project_id = f"group_{groupID}_rp_{batchLabel(id)}"
+                self.makeBatch(groupID,project_id,
+                            groupInfo,
+                            timestamps[batches==id].min(),
+                            timestamps[batches==id].max()+pd.Timedelta(minutes=int(groupInfo['Timing','file_duration','first'])),
+                            timestamps[batches==id].shape[0])
+                self.batchCost[f"{self.tempDir}/{project_id}.eddypro"] = cost['rp']*timestamps[batches==id].shape[0]+self.config['costModel']['batchOverhead']
+                plannedTasks[groupID][0].append(self.batchCost[f"{self.tempDir}/{project_id}.eddypro"])
+            self.makeBatch(groupID,f"group_{groupID}_fcc",
+                            groupInfo,
+                            timestamps.min(),
+                            timestamps.max()+pd.Timedelta(minutes=int(groupInfo['Timing','file_duration','first'])),
+                            timestamps.shape[0])
+            self.batchCost[f"{self.tempDir}/group_{groupID}_fcc.eddypro"] = cost['fcc']*timestamps.shape[0]+self.config['costModel']['batchOverhead']
         if len(self.rpBatches)<self.processes:self.processes = len(self.rpBatches)
+        # Predicted wall time of the batches as they will be run
+        self.predictedMakespan = simulateRuns(plannedTasks,self.processes)
 
     def batchesPerGroup(self,nInGroup,groupID):
+        # Minimum number of files per rp batch, as recommended for the selected settings (minDataReq) and batchSize>min
         self.minN = 1
         minN = 1
         for section,options in self.config['minDataReq'].items():
@@ -668,18 +1057,109 @@ class eddyProAPI():
             self.minN = max(self.minN,minN)
         if nInGroup<self.minN:
             print(f'Warning, available data in group {groupID} is below recommended size for selected settings.')
-        self.minN = min(max(self.config['batchSize']['min'],nInGroup),self.config['batchSize']['max'])
-        self.nBatchesPerGroup = np.floor(nInGroup/self.minN)
-        self.nBatchesPerGroup = min(self.processes,max(1,self.nBatchesPerGroup))
+        return(max(self.minN,self.config['batchSize']['min']))
+
+    def settingsHash(self):
+        # Identifies the EddyPro settings which affect run times (static template + user defined settings)
+        settings = {section:dict(self.eddyProStaticConfig[section]) for section in self.eddyProStaticConfig.sections()}
+        for section,options in self.userDefinedEddyProSettings.items():
+            settings.setdefault(section,{}).update({option:str(value) for option,value in options.items()})
+        return(hashlib.blake2b(json.dumps(settings,sort_keys=True).encode(),digest_size=8).hexdigest())
+
+    def readRuntimeHistory(self):
+        if os.path.isfile(self.config['runtimeHistory']):
+            with open(self.config['runtimeHistory']) as f:
+                return(json.load(f))
+        return({})
+
+    def runtimeCost(self,groupID):
+        # Seconds per file for rp and fcc runs of a group, from previous runs with the same settings
+        # Falls back to the mean of the other groups, then to the costModel default
+        history = self.readRuntimeHistory().get(self.settingsHash(),{})
+        cost = {}
+        for mode in ['rp','fcc']:
+            if f"group_{groupID}" in history and mode in history[f"group_{groupID}"]:
+                cost[mode] = history[f"group_{groupID}"][mode]
+            elif any(mode in h for h in history.values()):
+                cost[mode] = np.mean([h[mode] for h in history.values() if mode in h])
+            else:
+                cost[mode] = self.config['costModel']['secondsPerFile'][mode]
+        return(cost)
+
+    def planBatches(self,groupTimeStamps):
+        # Choose the calendar period of the rp batches of each group (see calendarBatches) to minimize the predicted makespan
+        # Starting from the coarsest of batchSize>periods for every group, the group with the longest rp batch is split by its
+        # next finer period while there are at most 4 batches per process, the plan with the shortest makespan (see simulateRuns) is kept
+        # Returns the batch number of each timestamp by group
+        overhead = self.config['costModel']['batchOverhead']
+        cost = {groupID:self.runtimeCost(groupID) for groupID in groupTimeStamps.keys()}
+        self.minBatchSize = {groupID:self.batchesPerGroup(timestamps.shape[0],groupID) for groupID,timestamps in groupTimeStamps.items()}
+        # Batches of each group by period, periods which don't give more batches than a coarser one are skipped
+        options = {}
+        for groupID,timestamps in groupTimeStamps.items():
+            options[groupID] = []
+            for freq in self.config['batchSize']['periods']:
+                batches = calendarBatches(timestamps,freq,self.minBatchSize[groupID])
+                if len(options[groupID]) == 0 or batches.max() > options[groupID][-1].max():
+                    options[groupID].append(batches)
+        def makespan(level):
+            tasks = {g:([cost[g]['rp']*n+overhead for n in np.bincount(options[g][k])[1:]],cost[g]['fcc']*groupTimeStamps[g].shape[0]+overhead)
+                     for g,k in level.items()}
+            return(simulateRuns(tasks,self.processes))
+        def nBatches(level):
+            return(sum(options[g][k].max() for g,k in level.items()))
+        level = {groupID:0 for groupID in groupTimeStamps.keys()}
+        best,bestMakespan = level,makespan(level)
+        while True:
+            splittable = [g for g,k in level.items() if k+1 < len(options[g]) and nBatches(level|{g:k+1}) <= 4*self.processes]
+            if len(splittable) == 0:
+                break
+            groupID = max(splittable,key=lambda g: cost[g]['rp']*np.bincount(options[g][level[g]]).max())
+            level = level | {groupID:level[groupID]+1}
+            if makespan(level) < bestMakespan:
+                best,bestMakespan = level,makespan(level)
+        return({groupID:options[groupID][k] for groupID,k in best.items()})
+
+    def updateRuntimeHistory(self):
+        # Record the seconds per file of completed runs (cached batches are skipped), smoothed over previous runs
+        history = self.readRuntimeHistory()
+        settings = history.setdefault(self.settingsHash(),{})
+        nFiles = {rp:files.shape[0] for rp,files in self.rpBatches.items()}
+        for id,tasks in self.groupTasks.items():
+            if 'fcc' in tasks:
+                nFiles[tasks['fcc'][0]] = sum(nFiles[rp] for rp in tasks['rp'])
+        for id,tasks in self.groupTasks.items():
+            for mode,runs in [('rp',tasks['rp']),('fcc',[tasks['fcc'][0]] if 'fcc' in tasks else [])]:
+                rates = [self.runStatus[r][1]/nFiles[r] for r in runs
+                         if r in self.runStatus and self.runStatus[r][0] == 0 and self.runStatus[r][1]>0 and nFiles[r]>0]
+                if len(rates)>0:
+                    rate = np.mean(rates)
+                    if mode in settings.get(id,{}):
+                        rate = 0.5*settings[id][mode]+0.5*rate
+                    settings.setdefault(id,{})[mode] = float(rate)
+        with open(self.config['runtimeHistory']+'.tmp','w') as f:
+            json.dump(history,f,indent=1)
+        os.replace(self.config['runtimeHistory']+'.tmp',self.config['runtimeHistory'])
+
+    def printPlan(self):
+        print(f'Batch plan for {self.processes} processes:')
+        plan = pd.DataFrame([[os.path.basename(fn).replace('.eddypro',''),self.rpBatches[fn].shape[0],
+                              self.rpBatches[fn].index.min(),self.rpBatches[fn].index.max(),np.round(cost,1)]
+                             for fn,cost in self.batchCost.items() if fn in self.rpBatches],
+                            columns=['batch','files','start','end','predicted seconds'])
+        print(plan.to_string(index=False))
+        print(f"Predicted wall time: {np.round(self.predictedMakespan,1)} seconds")
 
     def makeBatch(self,groupID,project_id,groupInfo,batchStart,batchEnd,batchCount):
         id = f'group_{groupID}'
         file_name = f"{self.tempDir}/{project_id}.eddypro"
         if '_rp_' in file_name:
-            self.rpBatches[file_name] = self.fileInventory.loc[((self.fileInventory.index>=batchStart)&
-                                           (self.fileInventory.index<=batchEnd)&
-                                           (self.fileInventory['groupID']==groupID))
-                                           ,['source','filename']].copy()
+            self.groupTasks.setdefault(id,{'rp':[]})['rp'].append(file_name)
+            # Files of the group are selected once, each batch is a slice of the (sorted) group inventory
+            if groupID not in self.groupInventory:
+                self.groupInventory[groupID] = self.fileInventory.loc[self.fileInventory['groupID']==groupID,['source','filename']].sort_index(kind='stable')
+            inventory = self.groupInventory[groupID]
+            self.rpBatches[file_name] = inventory.iloc[inventory.index.searchsorted(batchStart,'left'):inventory.index.searchsorted(batchEnd,'right')].copy()
             # Dump rp runs from subprocesses to root of group run
             out_path = self.runEddyPro.tempDir[id]
             ex_file = ''
@@ -697,7 +1177,24 @@ class eddyProAPI():
             sa_full_spectra = f"{self.runEddyPro.tempDir[id]}/eddypro_full_cospectra/"
             full_sp_avail='1'
             self.ex_fileList.append(ex_file)
+            self.groupTasks.setdefault(id,{'rp':[]})['fcc'] = (file_name,ex_file)
         print(f'Creating {file_name} for {batchCount} files')
+        pr_start_date=str(batchStart.date())
+        pr_start_time=str(batchStart.time())[:5]
+        pr_end_date=str(batchEnd.date())
+        pr_end_time=str(batchEnd.time())[:5]
+        # Settings of the group are merged once, only the batch specific settings are filled for each batch
+        if groupID not in self.batchTemplates:
+            self.batchTemplates[groupID] = self.compileBatchTemplate(groupID,groupInfo)
+        # Save the run and append to the list of runs
+        with open(file_name, 'w') as eddypro:
+            eddypro.write(';EDDYPRO_PROCESSING\n')
+            eddypro.write(self.batchTemplates[groupID].render(locals()))
+
+    def compileBatchTemplate(self,groupID,groupInfo):
+        # Merge the static, column definition, dynamic, and user defined settings of a group (see batchProcessing.eddyProTemplate)
+        # Dynamic settings which only depend on the names defined here are evaluated once per group
+        id = f'group_{groupID}'
         proj_file = self.config['Paths']['metaDir']+'/'+eval(self.config['groupFiles']['groupMetaData'])
         file_prototype = groupInfo['Custom','file_prototype','first']
         master_sonic = groupInfo['Instruments','instr_1_model','first']
@@ -705,77 +1202,80 @@ class eddyProAPI():
             file_type='0'
         else:
             file_type='1'
-        pr_start_date=str(batchStart.date())
-        pr_start_time=str(batchStart.time())[:5]
-        pr_end_date=str(batchEnd.date())
-        pr_end_time=str(batchEnd.time())[:5]
-                       
         eddyProCols = configparser.ConfigParser()
         eddyProCols.read(
             self.config['Paths']['metaDir']+'/'+eval(self.config['groupFiles']['eddyProCols'])
         )
-        self.groupEddyProConfig = configparser.ConfigParser() 
-        for section in self.eddyProStaticConfig.keys():
-            for option,value in self.eddyProStaticConfig[section].items():
-                if not self.groupEddyProConfig.has_section(section):
-                    self.groupEddyProConfig.add_section(section)
-                self.groupEddyProConfig.set(section, option, value)
-                if eddyProCols.has_section(section) and eddyProCols.has_option(section, option):
-                    self.groupEddyProConfig.set(section, option, eddyProCols[section][option])
-                # Use evaluate statement for dynamic settings
-                if self.eddyProDynamicConfig.has_section(section) and self.eddyProDynamicConfig.has_option(section, option):  
-                    setting = eval(self.eddyProDynamicConfig[section][option]).replace('\\','/')
-                    self.groupEddyProConfig.set(section, option, setting)
-                # User supplied variables will overwrite any other settings
-                if section in self.userDefinedEddyProSettings.keys() and option in self.userDefinedEddyProSettings[section].keys():
-                    self.groupEddyProConfig.set(section, option,str(self.userDefinedEddyProSettings[section][option]))
-        # Save the run and append to the list of runs
-        with open(file_name, 'w') as eddypro:
-            eddypro.write(';EDDYPRO_PROCESSING\n')
-            self.groupEddyProConfig.write(eddypro,space_around_delimiters=False)
+        return(batchProcessing.eddyProTemplate(self.eddyProStaticConfig,eddyProCols,self.eddyProDynamicConfig,
+                                               self.userDefinedEddyProSettings,globals(),locals()))
                     
     def runGroups(self):
         print(f'Initiating EddyPro Runs on {self.processes} cores at {self.priority} priority')
         self.subProcesIDs = []
+        # Exit status and wall time (seconds) of each EddyPro run
+        self.runStatus = {}
         if (__name__ == 'eddyProAPI' or __name__ == '__main__') and self.processes>1:
             # run routine in parallel
-            pb = progressbar(len(self.rpBatches),'')
+            # Tasks are scheduled as a DAG: once all rp batches of a group are complete, the merge + fcc run for that group
+            # is dispatched to the same pool, so it runs concurrently with the rp batches of other groups
+            # Only one task per process is in flight at a time, so ready fcc runs are not queued behind the remaining rp batches
+            pb = progressbar(len(self.rpBatches)+len(self.fccList),'')
+            done = queue.Queue()
+            remaining = {id:len(tasks['rp']) for id,tasks in self.groupTasks.items()}
+            batchGroup = {rp:id for id,tasks in self.groupTasks.items() for rp in tasks['rp']}
+            # Longest batches (as predicted by the cost model, see planBatches) are dispatched first
+            pending = sorted(self.rpBatches.items(),key=lambda item: -self.batchCost[item[0]])
+            ready = []
+            inFlight = 0
             with Pool(processes=self.processes) as pool:
-                for out in pool.imap(self.runEddyPro.rpRun,self.rpBatches.items(),chunksize=1):
+                for i in range(len(self.rpBatches)+len(self.fccList)):
+                    while inFlight < self.processes and (len(ready)>0 or len(pending)>0):
+                        if len(ready)>0:
+                            ready.sort(key=lambda toRun: -self.batchCost[toRun[1]])
+                            function,toRun = self.runEddyPro.fccGroup,ready.pop(0)
+                            key = toRun[1]
+                        else:
+                            function,toRun = self.runEddyPro.rpRun,pending.pop(0)
+                            key = toRun[0]
+                        pool.apply_async(function,(toRun,),
+                                         callback=lambda out,key=key: done.put((key,out)),
+                                         error_callback=lambda err,key=key: done.put((key,err)))
+                        inFlight += 1
+                    key,out = done.get()
+                    inFlight -= 1
                     pb.step()
-                    self.subProcesIDs.append(out)
+                    if isinstance(out,BaseException):
+                        # Recorded like a run with a non-zero exit status, the other groups carry on
+                        print(f'\n{os.path.basename(key)} failed: {out!r}')
+                        self.runStatus[key] = (-1,0.0)
+                    else:
+                        self.subProcesIDs.append(out[0])
+                        self.runStatus[key] = out[1:]
+                    if key in batchGroup:
+                        id = batchGroup[key]
+                        remaining[id] -= 1
+                        if remaining[id] == 0 and 'fcc' in self.groupTasks[id]:
+                            fcc,ex_file = self.groupTasks[id]['fcc']
+                            ready.append((id,fcc,ex_file,self.config['rpIntermediary']))
                 pool.close()
                 pb.close()
         else:
             # run routine sequentially for debugging
             for i,toRun in enumerate(self.rpBatches.items()):
                 out = self.runEddyPro.rpRun(toRun)
-                self.subProcesIDs.append(out)
-        self.rpMerge()
-        for fcc in self.fccList:
-            out = self.runEddyPro.fccRun(fcc)
-            self.subProcesIDs.append(out)
+                self.subProcesIDs.append(out[0])
+                self.runStatus[toRun[0]] = out[1:]
+            for id,tasks in self.groupTasks.items():
+                if 'fcc' in tasks:
+                    fcc,ex_file = tasks['fcc']
+                    out = self.runEddyPro.fccGroup((id,fcc,ex_file,self.config['rpIntermediary']))
+                    self.subProcesIDs.append(out[0])
+                    self.runStatus[fcc] = out[1:]
+        failed = [os.path.basename(k) for k,(returncode,wallTime) in self.runStatus.items() if returncode != 0]
+        print(f"{len(self.runStatus)-len(failed)} of {len(self.runStatus)} EddyPro runs completed, total run time {np.round(sum(w for r,w in self.runStatus.values()),1)} seconds")
+        if len(failed)>0:
+            print('Failed runs: ',', '.join(failed))
     
-    def rpMerge(self):
-        for groupID in self.configurationGroups.index:
-            for filePattern,kwargs in self.config['rpIntermediary'].items():
-                id = f'group_{groupID}'
-                search_path = os.path.abspath(f"{self.runEddyPro.tempDir[id]}/**{filePattern}**.csv")
-                toMerge = glob(search_path)
-                if len(toMerge)>0:
-                    Temp = pd.DataFrame()
-                    if 'parse_dates' in kwargs and type(kwargs['parse_dates'])==list:
-                        val = kwargs['parse_dates']
-                        key = tuple(['datetime']+['' for i in range(len(kwargs['header'])-1)])
-                        kwargs['parse_dates'] = {key:val}
-                    for i,fn in enumerate(toMerge):
-                        Temp = pd.concat([Temp,pd.read_csv(fn,**kwargs)])
-                    Temp = Temp.set_index(list(kwargs['parse_dates'].keys())[0]).sort_index()
-                    Temp = Temp.sort_index()
-                    fn = [f for f in self.ex_fileList if id in f][0].replace('fluxnet',filePattern)
-                    print('Saving As \n',fn)
-                    Temp.to_csv(fn,index=False)
-
     def copyFinalOutputs(self):
         print('Transferring Final Outputs')
         for toDel in self.subProcesIDs:
@@ -783,10 +1283,12 @@ class eddyProAPI():
                 shutil.rmtree(toDel)
         d_out = os.path.abspath(self.config['Paths']['outputDir']+'/'+datetime.strftime(datetime.now(),format='%Y%m%d%H%M'))
         d_in = os.path.abspath(self.tempDir)
-        if os.path.isdir(d_out) == False:
-            os.makedirs(d_out)
-        batchProcessing.pasteWithSubprocess(d_in,d_out,option='xcopy')
-        shutil.rmtree(d_in)
+        # Outputs are published to a new directory in one step, add a suffix if the timestamp is already taken
+        n = 0
+        while os.path.exists(d_out+(f'_{n}' if n > 0 else '')):
+            n += 1
+        d_out = d_out+(f'_{n}' if n > 0 else '')
+        batchProcessing.publishDirectory(d_in,d_out,self.config['transferThreads'])
         if self.biometUser and os.path.isdir(self.config['rootDir']['Database']):
             for outFile,metaData in self.config['fccFinalOutputs'].items():
                 toDump = fnmatch.filter(os.listdir(d_out),f'*{outFile}*')
@@ -799,6 +1301,14 @@ class eddyProAPI():
                                         stage='epOutputs',
                                         tag=self.name)
 
+def strToBool(value):
+    # Value of a bool command line argument, e.g., --plan True, --rpCache False (a bare --plan is True)
+    if value.lower() in ['true','t','yes','y','1']:
+        return(True)
+    elif value.lower() in ['false','f','no','n','0']:
+        return(False)
+    raise argparse.ArgumentTypeError(f'{value} is not True or False')
+
 # If called from command line ...
 if __name__ == '__main__':
 
@@ -816,6 +1326,9 @@ if __name__ == '__main__':
         elif dt == type([]):
             nargs = '+'
             dt = type('')
+        elif dt == type(True):
+            CLI.add_argument(f"--{key}",nargs=nargs,type=strToBool,const=True,default=val)
+            continue
         CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val)
 
     # parse the command line